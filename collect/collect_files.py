@@ -266,6 +266,14 @@ if hs_video_files:
             except Exception:
                 pass
 
+            # Record frame count, fps, size and codec in the shared video
+            # metadata cache, so later steps do not open the video for them
+            try:
+                from flow.metadata import load_metadata
+                load_metadata(closest_hs_video)
+            except Exception as e:
+                print(f"⚠️  WARNING: Cannot read HS video metadata: {e}")
+
     # Find and copy related files with same prefix (.mat, .trk, _calib.csv)
     # Process these even if HS video was rejected due to timestamp
     if closest_hs_video:
@@ -1,7 +1,7 @@
 #!/bin/bash
 
 if [ $# -eq 0 ]; then
-    echo "Usage: $0 <input_video_file>"
+    echo "Usage: $0 <input_video_file> [proxy]"
     exit 1
 fi
 
@@ -20,3 +20,15 @@ output=$(ssh -o "StrictHostKeyChecking no" -t login1.int.janelia.org \
 
 echo "Submitted job to cluster for converting $filename"
 
+# optionally also write the grayscale all-intra calibration proxy (next to
+# the linked video); run_calibration already writes it for new sessions
+if [ "$2" == "proxy" ]; then
+    project_root=$(cd "$(dirname "$0")/.." && pwd)
+    conda_python=/groups/zhang/home/zhangl5/conda/envs/video/bin/python3
+    output=$(ssh -o "StrictHostKeyChecking no" -t login1.int.janelia.org \
+      "bsub -J proxy_mov -o /dev/null -n 1 '$conda_python \
+        \"$project_root/flow/make_proxy.py\" \"$input_file\"'" 2>&1)
+
+    echo "Submitted job to cluster for the proxy of $filename"
+fi
+
@@ -1,24 +1,43 @@
 #!/usr/bin/env python3
 """
-Walk the new_format directory and generate a zaber-to-HS-video frame mapping CSV
-for every session that contains a calibration file.
+Walk the new_format directory and generate a zaber-to-HS-video frame mapping
+for every session that contains a calibration file: the compact sync model
+(_sync.npz, see flow/sync.py) and the dense memory-mappable index
+(_hs_index.npy), plus the _hs_index.csv with --csv or when the session
+already has one.
 
 Usage:
-    python generate_index.py
+    python generate_index.py [--csv] [--force] [--n-worker N]
+
+Sessions are processed in parallel, and only rebuilt when their outputs
+are missing or stale (see is_stale).
 """
 
 import os
+import sys
 import glob
+import hashlib
+import argparse
+import multiprocessing
 import numpy as np
 import pandas as pd
-import cv2
+
+# Add project root to path so we can import flow modules
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_ROOT)
+
+from flow.calibrate import n_worker
+from flow.metadata import load_metadata
+from flow.sync import SyncModel, sync_path, index_path
 
 
 NEW_FORMAT_BASE = '/groups/dennis/dennislab/data/new_format'
 HS_FRAME_RATE = 120
 
 
-def generate_hs_mapping(csv_path, calib_path, hs_video_path, output_path):
+def generate_hs_mapping(csv_path, calib_path, hs_video_path, output_path,
+                        chunk_size=None, model=None, hs_index=None):
     """
     Generate a CSV mapping each zaber index to a high-speed video frame index.
 
@@ -33,43 +52,122 @@ def generate_hs_mapping(csv_path, calib_path, hs_video_path, output_path):
     calib_path : str
         Path to the calibration CSV (must contain 'video_index' and 'zaber_index').
     hs_video_path : str
-        Path to the HS video file (used to determine total frame count).
+        Path to the HS video file (used to determine total frame count,
+        read from the shared video metadata cache).
     output_path : str
         Path for the output CSV file.
+    chunk_size : int, optional
+        Map and write this many zaber samples at a time, to bound the
+        memory of very long sessions. The output is the same.
+    model : SyncModel, optional
+        Already built sync model of these files, used instead of reading them.
+    hs_index : array_like, optional
+        Dense index already written by SyncModel.write_index (memory-mapped),
+        copied to the CSV instead of mapping the samples again.
+
+    Returns
+    -------
+    int
+        Number of zaber samples that fall inside the HS video.
     """
-    time_array = pd.read_csv(csv_path, low_memory=False)['relative_time'].to_numpy()
-
-    calib_array = pd.read_csv(calib_path)
-    calib_axis = calib_array[['video_index', 'zaber_index']].to_numpy().T
-    zaber_axis = calib_axis[1]
-    video_axis = calib_axis[0]
-
-    # get total frame count from the HS video
-    cap = cv2.VideoCapture(hs_video_path)
-    hs_length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    cap.release()
-
-    hs_index = np.zeros(time_array.size, dtype=int)
-    for idx in range(time_array.size):
-        # find the closest anchor in zaber_axis
-        zaber_idx = np.argmin(np.abs(zaber_axis - idx))
-        zaber_frame = zaber_axis[zaber_idx]
-        video_frame = video_axis[zaber_idx]
-
-        delta = (time_array[idx] - time_array[int(zaber_frame)]) * HS_FRAME_RATE
-        frame_idx = int(video_frame + delta)
-
-        # mark out-of-range frames as -1
-        if frame_idx < 0 or frame_idx >= hs_length:
-            hs_index[idx] = -1
+    if model is None and hs_index is None:
+        model = SyncModel.from_files(csv_path, calib_path, hs_video_path,
+                                     HS_FRAME_RATE)
+
+    n_sample = len(model) if hs_index is None else len(hs_index)
+    chunk_size = chunk_size or max(n_sample, 1)
+    n_valid = 0
+
+    # each chunk goes straight to the file, nothing is kept
+    for start in range(0, n_sample, chunk_size):
+        idx = np.arange(start, min(start + chunk_size, n_sample))
+        if hs_index is None:
+            frame = model.hs_frame(idx)
         else:
-            hs_index[idx] = frame_idx
+            frame = np.asarray(hs_index[start:idx[-1] + 1], dtype=int)
+        n_valid += int(np.sum(frame >= 0))
+
+        df = pd.DataFrame({'zaber_index': idx, 'hs_index': frame})
+        df.to_csv(output_path, index=False, header=start == 0,
+                  mode='w' if start == 0 else 'a')
+
+    if n_sample == 0:
+        pd.DataFrame({'zaber_index': [], 'hs_index': []}).to_csv(output_path,
+                                                                index=False)
+    return n_valid
+
+
+def file_hash(path, block_size=1 << 20):
+    """SHA-1 of the file content."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def generate_sync(csv_path, calib_path, hs_video_path, prefix,
+                  chunk_size=None, csv=False):
+    """
+    Write the sync model (<prefix>_sync.npz) and the memory-mappable dense
+    index (<prefix>_hs_index.npy) of a session, and the CSV index
+    (<prefix>_hs_index.csv) if csv=True.
+
+    The content hashes of the behavioral and calibration CSVs are saved
+    with the model, see is_stale.
+
+    Returns the dense index, memory-mapped.
+    """
+    model = SyncModel.from_files(csv_path, calib_path, hs_video_path,
+                                 HS_FRAME_RATE)
 
-    df = pd.DataFrame({'zaber_index': np.arange(time_array.size), 'hs_index': hs_index})
-    df.to_csv(output_path, index=False)
+    # the dense index first, so the model (checked by is_stale) is only
+    # there once all the outputs are
+    hs_index = model.write_index(index_path(prefix), chunk_size)
+    if csv:
+        generate_hs_mapping(csv_path, calib_path, hs_video_path,
+                            f'{prefix}_hs_index.csv', chunk_size,
+                            hs_index=hs_index)
+
+    model.save(sync_path(prefix), csv_hash=file_hash(csv_path),
+               calib_hash=file_hash(calib_path))
     return hs_index
 
 
+def is_stale(csv_path, calib_path, hs_video_path, prefix, csv=False):
+    """
+    Whether the outputs of a session have to be rebuilt: one is missing,
+    or an input is newer than them and its content changed (hash of the
+    CSVs, frame count of the HS video). Inputs only touched get the
+    outputs touched too, so they are not hashed again on the next run.
+    """
+    output_paths = [index_path(prefix), sync_path(prefix)]
+    if csv:
+        output_paths.append(f'{prefix}_hs_index.csv')
+    if not all(os.path.exists(path) for path in output_paths):
+        return True
+
+    output_time = min(os.stat(path).st_mtime_ns for path in output_paths)
+    input_time = max(os.stat(path).st_mtime_ns
+                     for path in [csv_path, calib_path, hs_video_path])
+    if input_time <= output_time:
+        return False
+
+    with np.load(sync_path(prefix)) as data:
+        if 'csv_hash' not in data or 'calib_hash' not in data:
+            return True
+        changed = (str(data['csv_hash']) != file_hash(csv_path) or
+                   str(data['calib_hash']) != file_hash(calib_path) or
+                   int(data['hs_length']) !=
+                   load_metadata(hs_video_path)['n_frame'])
+    if changed:
+        return True
+
+    for path in output_paths:
+        os.utime(path)
+    return False
+
+
 def find_file(session_dir, suffix):
     """Find a file in the session directory by suffix."""
     for f in os.listdir(session_dir):
@@ -78,56 +176,102 @@ def find_file(session_dir, suffix):
     return None
 
 
-def process_session(session_dir):
-    """Process a single session directory."""
+def process_session(session_dir, csv=False, force=False):
+    """
+    Process a single session directory.
+
+    Returns (status, message), status one of 'built', 'up-to-date',
+    'skipped' or 'failed', or None for a session without calibration.
+    """
     calib_path = find_file(session_dir, '_calib.csv')
     if calib_path is None:
-        return
+        return None
 
     csv_path = find_file(session_dir, '_ccf_all_params_file.csv')
     if csv_path is None:
-        print(f"  Skipping {session_dir}: no behavioral CSV")
-        return
+        return 'skipped', f"Skipping {session_dir}: no behavioral CSV"
 
     hs_video_path = find_file(session_dir, '_hs_cmp.avi')
     if hs_video_path is None:
-        print(f"  Skipping {session_dir}: no HS video")
-        return
+        return 'skipped', f"Skipping {session_dir}: no HS video"
 
-    # output file: same prefix as calib file, with _hs_index.csv
+    # output files: same prefix as calib file, with _sync.npz, _hs_index.npy
+    # (and _hs_index.csv)
     prefix = os.path.basename(calib_path).replace('_calib.csv', '')
-    output_path = os.path.join(session_dir, f'{prefix}_hs_index.csv')
+    prefix = os.path.join(session_dir, prefix)
+    output_path = sync_path(prefix)
 
-    if os.path.exists(output_path):
-        print(f"  Already exists: {output_path}")
-        return
+    # a CSV index from an earlier run is an output too: it is checked and
+    # rewritten with the others, never left stale next to them
+    csv = csv or os.path.exists(f'{prefix}_hs_index.csv')
 
     try:
-        hs_index = generate_hs_mapping(csv_path, calib_path, hs_video_path, output_path)
+        if not force and not is_stale(csv_path, calib_path, hs_video_path,
+                                      prefix, csv):
+            return 'up-to-date', f"Up to date: {output_path}"
+
+        hs_index = generate_sync(csv_path, calib_path, hs_video_path, prefix,
+                                 csv=csv)
         n_valid = np.sum(hs_index >= 0)
         n_total = hs_index.size
-        print(f"  Generated: {os.path.basename(output_path)} "
-              f"({n_valid}/{n_total} valid frames)")
+        return 'built', (f"Generated: {os.path.basename(output_path)} "
+                         f"({n_valid}/{n_total} valid frames)")
     except Exception as e:
-        print(f"  Error processing {session_dir}: {e}")
+        return 'failed', f"Error processing {session_dir}: {e}"
+
+
+def _process_session(args):
+    session_dir, csv, force = args
+    return session_dir, process_session(session_dir, csv, force)
 
 
 def main():
-    animal_dirs = sorted(glob.glob(os.path.join(NEW_FORMAT_BASE, '*')))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv', action='store_true',
+                        help='also write the dense _hs_index.csv')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild every session, even if up to date')
+    parser.add_argument('--n-worker', type=int, default=n_worker(),
+                        help='number of sessions processed in parallel')
+    args = parser.parse_args()
 
-    for animal_dir in animal_dirs:
+    session_dirs = []
+    for animal_dir in sorted(glob.glob(os.path.join(NEW_FORMAT_BASE, '*'))):
         if not os.path.isdir(animal_dir):
             continue
+        session_dirs += [session_dir for session_dir
+                         in sorted(glob.glob(os.path.join(animal_dir, '*')))
+                         if os.path.isdir(session_dir)]
 
-        animal_name = os.path.basename(animal_dir)
-        session_dirs = sorted(glob.glob(os.path.join(animal_dir, '*')))
+    tasks = [(session_dir, args.csv, args.force) for session_dir in session_dirs]
+    if args.n_worker > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(args.n_worker, len(tasks)))
+        results = pool.imap_unordered(_process_session, tasks)
+    else:
+        pool = None
+        results = map(_process_session, tasks)
 
-        for session_dir in session_dirs:
-            if not os.path.isdir(session_dir):
+    summary = {'built': [], 'up-to-date': [], 'skipped': [], 'failed': []}
+    try:
+        for session_dir, result in results:
+            if result is None:
                 continue
+            status, message = result
+            summary[status].append(session_dir)
+
+            session_name = os.path.relpath(session_dir, NEW_FORMAT_BASE)
+            print(f"{session_name}: {message}")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-            print(f"Processing {animal_name}/{os.path.basename(session_dir)}")
-            process_session(session_dir)
+    print(f"\nBuilt: {len(summary['built'])}, "
+          f"up to date: {len(summary['up-to-date'])}, "
+          f"skipped: {len(summary['skipped'])}, "
+          f"failed: {len(summary['failed'])}")
+    for session_dir in summary['failed']:
+        print(f"  Failed: {session_dir}")
 
 
 if __name__ == '__main__':
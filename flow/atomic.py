@@ -0,0 +1,26 @@
+'''
+Atomic file writes: the content goes to a temporary file next to the
+target and is renamed over it once complete, so a killed or failed job
+never leaves a partial cache, index or video behind
+'''
+import os
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_path(path):
+    '''
+    Temporary path to write instead of path (same directory, same
+    extension), renamed to path when the block exits normally and
+    removed when it raises
+    '''
+    root, ext = os.path.splitext(path)
+    tmp_path = '%s.%d.tmp%s' % (root, os.getpid(), ext)
+    try:
+        yield tmp_path
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.replace(tmp_path, path)
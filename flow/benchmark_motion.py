@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Benchmark global-motion estimators for calibration.
+
+Runs the anchor lag estimate with every estimator in MOTION_ESTIMATORS (and
+every temporal step in --steps) on the same windows, and reports throughput
+(video frames/s) and agreement of the lags (in seconds and HS frames) with the
+reference: an existing _calib.csv if given, otherwise Farneback at step=4.
+
+Usage:
+    python flow/benchmark_motion.py <zaber_path> <video_path> \
+        [--calib CALIB_CSV] [--n-point 10] [--window 45] \
+        [--methods farneback dis] [--steps 4 8 16] [--subsample]
+"""
+import argparse
+import sys
+import os
+import time
+import numpy as np
+import pandas as pd
+
+# Add project root to path so we can import flow modules
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_ROOT)
+
+from flow.calibrate import CalibrationSession, calib_anchor, calib_video_init
+from flow.compute import MOTION_ESTIMATORS
+
+
+def run_anchor(args, t0, init_lag, method, step, subsample):
+    with CalibrationSession(args.zaber_path, args.video_path, step=step,
+                            cache=False, method=method,
+                            subsample=subsample) as session:
+        time_start = time.time()
+        calibration = calib_anchor(session, t0, args.window, init_lag,
+                                   pbar=False)
+        elapsed = time.time() - time_start
+
+    return elapsed, calibration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('zaber_path', type=str)
+    parser.add_argument('video_path', type=str)
+    parser.add_argument('--calib', type=str, default=None,
+                        help='existing _calib.csv used as the lag reference')
+    parser.add_argument('--n-point', type=int, default=10)
+    parser.add_argument('--window', type=int, default=45)
+    parser.add_argument('--steps', type=int, nargs='+', default=[4],
+                        help='temporal sampling steps to compare')
+    parser.add_argument('--subsample', action='store_true',
+                        help='sub-sample (parabolic) lag refinement')
+    parser.add_argument('--methods', type=str, nargs='+',
+                        default=list(MOTION_ESTIMATORS),
+                        choices=list(MOTION_ESTIMATORS))
+    args = parser.parse_args()
+
+    window = args.window
+
+    # anchors and reference lags
+    if args.calib is not None:
+        calib = pd.read_csv(args.calib)
+        rows = np.unique(np.linspace(0, len(calib) - 1,
+                                     args.n_point).astype(int))
+        ref_lag = calib['lag'].to_numpy()[rows]
+        zaber_index = calib['zaber_index'].to_numpy()[rows]
+
+        # compute_lag stores zaber_index = frame of (t0 - lag)
+        with CalibrationSession(args.zaber_path, args.video_path,
+                                cache=False) as session:
+            t0 = session.zaber.zaber_t[zaber_index] + ref_lag
+        init_lag = float(np.median(ref_lag))
+        reference = 'calib csv'
+    else:
+        with CalibrationSession(args.zaber_path, args.video_path,
+                                cache=False) as session:
+            init_lag, init_window, t_max = calib_video_init(
+                args.zaber_path, args.video_path, window, session)
+        t0 = np.linspace(init_window, t_max, args.n_point)
+        ref_lag = None
+        reference = 'farneback, step=4'
+
+    n_frame = len(t0) * window * 120
+    print(f'{len(t0)} anchors x {window} s windows, '
+          f'subsample={args.subsample}, reference: {reference}\n')
+
+    results = {}
+    for method in args.methods:
+        for step in args.steps:
+            results[(method, step)] = run_anchor(args, t0, init_lag, method,
+                                                 step, args.subsample)
+
+    # production setting as the reference when there is no calib csv
+    if ref_lag is None:
+        if ('farneback', 4) in results and not args.subsample:
+            calibration = results[('farneback', 4)][1]
+        else:
+            calibration = run_anchor(args, t0, init_lag,
+                                     'farneback', 4, False)[1]
+        ref_lag = calibration[0]
+
+    print(f'{"method":<10} {"step":>4} {"time (s)":>9} {"frames/s":>9} '
+          f'{"max |dlag| (s)":>15} {"(frames)":>9} {"within 1/30 s":>14} '
+          f'{"mean corr":>10}')
+    for (method, step), (elapsed, calibration) in results.items():
+        dlag = np.abs(calibration[0] - ref_lag)
+        print(f'{method:<10} {step:>4} {elapsed:>9.1f} {n_frame / elapsed:>9.0f} '
+              f'{np.max(dlag):>15.3f} {np.max(dlag) * 120:>9.1f} '
+              f'{np.mean(dlag <= 4 / 120 + 1e-9):>14.0%} '
+              f'{np.mean(calibration[3]):>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
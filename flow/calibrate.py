@@ -1,15 +1,24 @@
+import io
+import os
+import hashlib
+import multiprocessing
 import numpy as np
 import cv2
 import pandas as pd
 from scipy import stats
 from scipy.interpolate import interp1d
-from scipy.signal import correlate
+from scipy.signal import correlate, fftconvolve
 from .compute import *
+from .atomic import atomic_path
+from .keyframes import load_keyframes
+from .metadata import load_metadata
+from .params import load_params
 
 class MotionData():
     def __init__(self, dx, dy, dt, t=None):
-        self.dx = stats.zscore(dx)
-        self.dy = stats.zscore(dy)
+        # a constant signal (e.g., fully gated idle window) scores zero
+        self.dx = np.nan_to_num(stats.zscore(dx))
+        self.dy = np.nan_to_num(stats.zscore(dy))
         self.dt = dt
 
         if t is None:
@@ -33,36 +42,137 @@ class MotionData():
                       fill_value="extrapolate")(t)
         return dx, dy
 
-def cross_correlate(f, g, combine=False):
+def cross_correlate(f, g, combine=False, max_lag=None):
+    '''
+    Normalized cross-correlation of video (f) and zaber (g) motion over
+    lags in [-max_lag, max_lag] (sec), or over all lags if max_lag is None
+    '''
     gx, gy = g.interpolate(f.t)
-    lags = np.arange(-len(f.dx) + 1, len(f.dx)) * f.dt
+    n_lag = len(f.dx) - 1
+    if max_lag is not None:
+        n_lag = min(int(np.ceil(max_lag / f.dt)), n_lag)
+    lags = np.arange(-n_lag, n_lag + 1) * f.dt
 
     if combine:
-        corr = (correlate(f.dx, gx, mode='full') +
-                correlate(f.dy, gy, mode='full')) / \
-                    signal_power([np.concatenate([f.dx, f.dy]),
-                                  np.concatenate([gx, gy])])
+        # dx and dy as one complex signal: Re{(fx + i fy)(gx - i gy)*}
+        # is the sum of the two correlations, computed in one transform
+        zf = f.dx + 1j * f.dy
+        zg = gx + 1j * gy
+        corr = lag_correlate(zf, zg, n_lag).real / signal_power([zf, zg])
 
         return corr, lags
 
     # else
-    corr_x = correlate(f.dx, gx, mode='full') / signal_power([f.dx, gx])
-    corr_y = correlate(f.dy, gy, mode='full') / signal_power([f.dy, gy])
+    corr_x = lag_correlate(f.dx, gx, n_lag) / signal_power([f.dx, gx])
+    corr_y = lag_correlate(f.dy, gy, n_lag) / signal_power([f.dy, gy])
 
     return corr_x, corr_y, lags
 
+def peak_lag(corr, lags, subsample=False):
+    '''
+    Lag and value of the correlation peak (along the last axis).
+    With subsample=True, a parabola through the peak and its two
+    neighbours places the peak between lag samples
+    '''
+    single = np.ndim(corr) == 1
+    corr = np.atleast_2d(corr)
+    rows = np.arange(corr.shape[0])
+
+    peak = np.argmax(corr, axis=1)
+    lag = lags[peak].astype(float)
+    value = corr[rows, peak]
+
+    if subsample and len(lags) > 2:
+        inner = np.clip(peak, 1, len(lags) - 2)
+        y0 = corr[rows, inner - 1]
+        y1 = corr[rows, inner]
+        y2 = corr[rows, inner + 1]
+
+        # vertex of the parabola, only for an interior and finite peak
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denom = y0 - 2 * y1 + y2
+            valid = (peak == inner) & np.isfinite(y0) & \
+                    np.isfinite(y2) & (denom < 0)
+            delta = np.where(valid, 0.5 * (y0 - y2) / denom, 0.0)
+
+        lag = lag + delta * (lags[1] - lags[0])
+        value = np.where(valid, y1 - 0.25 * (y0 - y2) * delta, value)
+
+    if single:
+        return float(lag[0]), value[0]
+    return lag, value
+
+def lag_correlate(f, g, n_lag):
+    '''
+    sum_n f[n + k] * conj(g[n]) for k in [-n_lag, n_lag] (samples),
+    same as correlate(f, g, mode='full') restricted to those lags
+    '''
+    n = len(f)
+    if n_lag >= n - 1:
+        return correlate(f, g, mode='full')
+
+    # direct evaluation costs O(n * n_lag), cheaper than the full FFT
+    # only for a band of a few lags
+    if 2 * n_lag + 1 < np.log2(n):
+        windows = np.lib.stride_tricks.sliding_window_view(np.pad(f, n_lag), n)
+        return windows @ np.conj(g)
+
+    corr = fftconvolve(f, np.conj(g)[::-1], mode='full')
+    return corr[n - 1 - n_lag:n + n_lag]
+
 def signal_power(ts):
-    power_sum = np.array([np.sum(f ** 2) for f in ts])
+    power_sum = np.array([np.vdot(f, f).real for f in ts])
     return np.sqrt(np.prod(power_sum))
 
+def cross_correlate_batch(fs, gs, max_lag=None):
+    '''
+    Combined (dx + dy) cross-correlation of many windows at once.
+    Windows are zero-padded to a common length and correlated with a
+    single FFT along the last axis; lags that do not exist for a shorter
+    window are set to -inf. Returns corr (n_window, n_lag) and lags
+    '''
+    n_max = max(len(f.dx) for f in fs)
+    shape = (len(fs), n_max)
+    zf, zg = np.zeros(shape, dtype=complex), np.zeros(shape, dtype=complex)
+    valid = np.zeros((len(fs), 2 * n_max - 1), dtype=bool)
+
+    for i, (f, g) in enumerate(zip(fs, gs)):
+        n = len(f.dx)
+        gx, gy = g.interpolate(f.t)
+        zf[i, :n] = f.dx + 1j * f.dy
+        zg[i, :n] = gx + 1j * gy
+        valid[i, n_max - n:n_max + n - 1] = True
+
+    # correlate(a, b) == convolve(a, conj(b)[::-1]) in 'full' mode
+    corr = fftconvolve(zf, np.conj(zg)[:, ::-1], mode='full', axes=1).real
+
+    power = np.sqrt(np.sum(np.abs(zf) ** 2, axis=1) *
+                    np.sum(np.abs(zg) ** 2, axis=1))
+    corr = np.where(valid, corr / power[:, None], -np.inf)
+    lags = np.arange(-n_max + 1, n_max) * fs[0].dt
+
+    if max_lag is not None:
+        n_lag = min(int(np.ceil(max_lag / fs[0].dt)), n_max - 1)
+        band = slice(n_max - 1 - n_lag, n_max + n_lag)
+        corr, lags = corr[:, band], lags[band]
+
+    return corr, lags
+
 class VideoData():
-    def __init__(self, video_path, step, dsp=0.25, fr=120):
+    def __init__(self, video_path, step, dsp=0.25, fr=120, stream=True,
+                 cache=True, cache_dir=None, method='farneback', n_thread=1,
+                 crop=None, mask=None, proxy=True, keyframes=True,
+                 backend='opencv', gate=None):
+        self.video_path = video_path
         self.video = cv2.VideoCapture(video_path)
 
         if not self.video.isOpened():
             # raise an error if the video file cannot be opened
             raise ValueError("Error: Cannot open video file.")
 
+        # frame count and size from the shared metadata cache
+        self.metadata = load_metadata(video_path)
+
         # flip y-axis for motion
         if video_path[-3:] == 'avi':
             self.flip_x = False
@@ -76,14 +186,274 @@ class VideoData():
         self.fr = fr
         self.dt = 1 / fr * step
 
+        # sample k is the flow between frames (k + 1) * step - 1 and
+        # (k + 2) * step - 1, centered 1.5 * step - 1 frames after k * dt;
+        # shift the time axis so any step lines up with step=4 results
+        self.t_offset = 1.5 * (step - 4) / fr
+
+        # stream: reduce flow frame by frame in constant memory
+        self.stream = stream
+
+        # global motion estimator, see MOTION_ESTIMATORS
+        if method not in MOTION_ESTIMATORS:
+            raise ValueError(f"Error: Unknown motion estimator '{method}'.")
+        if not stream and method != 'farneback':
+            raise ValueError("Error: Full-field flow requires method='farneback'.")
+        self.method = method
+
+        # n_thread > 1: overlap decoding and motion estimation
+        self.n_thread = n_thread
+
+        # gate: skip motion estimation on frame pairs whose mean absolute
+        # difference is below this many gray levels (see FrameGate)
+        self.gate = None if gate is None else FrameGate(gate)
+
+        # region of interest, in video pixels: crop (x, y, w, h) is cut
+        # before resizing, mask (boolean array, image path or 'auto')
+        # restricts the pixels averaged into the global motion
+        self.crop, self.mask = self.load_roi(crop, mask)
+
+        # frames are resized by sample, cut by flow_crop and averaged over
+        # flow_mask; a proxy (see write_proxy) is read instead of the video
+        # when one exists, its frames are already gray and resized to dsp
+        self.sample, self.flow_crop, self.flow_mask = dsp, self.crop, self.mask
+        self.proxy_path = None
+        if proxy:
+            self.open_proxy()
+
+        # keyframe numbers of the file read (see flow.keyframes), loaded
+        # by the first read that has to seek, see seek_keyframes, unless
+        # given as an array (already loaded by the parent of a worker)
+        if isinstance(keyframes, bool):
+            self.use_keyframes, self.keyframes = keyframes, None
+        else:
+            self.use_keyframes, self.keyframes = True, np.asarray(keyframes)
+
+        # backend 'ffmpeg': frames are selected, cropped, converted and
+        # resized inside an ffmpeg process (see FFmpegReader), falling
+        # back to OpenCV when ffmpeg is not installed
+        if backend not in ('opencv', 'ffmpeg'):
+            raise ValueError(f"Error: Unknown video backend '{backend}'.")
+        if backend == 'ffmpeg' and not stream:
+            raise ValueError("Error: The ffmpeg backend requires stream=True.")
+        self.reader = None
+        if backend == 'ffmpeg':
+            if FFmpegReader.available():
+                self.reader = FFmpegReader(self.proxy_path or video_path,
+                                           self.sample, self.flow_crop)
+                self.flow_mask = scale_mask(self.flow_mask, self.flow_crop,
+                                            self.sample)
+                self.sample, self.flow_crop = 1.0, None
+            else:
+                print('⚠️ Warning: ffmpeg not found, reading the video with OpenCV.')
+
+        # whole-session motion trace (2, n_flow), only used once loaded by
+        # load_trace (trace mode): it is sampled on the global step grid,
+        # not aligned on each window start as the seek path is
+        self.trace = None
+        self.cache = cache
+        self.cache_dir = cache_dir
+
     def get_motion(self, start, length):
-        frames = get_frames(self.video, start, start + length,
-                            self.dsp, self.step, self.fr)
+        shift = 0
+        if self.trace is not None:
+            dx_bar, dy_bar, shift = self.trace_window(start, length)
+
+        elif self.stream:
+            dx_bar, dy_bar = self.reduce_flow(self.iter_frames(start,
+                                                               start + length))
+
+        else:
+            frames = get_frames(self.video, start, start + length,
+                                self.sample, self.step, self.fr,
+                                crop=self.flow_crop,
+                                keyframes=self.seek_keyframes(start))
+
+            delta = compute_flow(frames, gate=self.gate)
+            mask = scale_mask(self.flow_mask, self.flow_crop, self.sample)
+            dx_bar, dy_bar = average_flow(delta, self.flip_x, self.flip_y, mask)
+
+        motion = MotionData(dx_bar, dy_bar, self.dt)
+        motion.t = motion.t + self.t_offset + shift
+        return motion
+
+    def load_trace(self, pbar=False, cache=None):
+        '''
+        Decode the whole video sequentially once and keep the global
+        motion trace, so that get_motion slices it instead of decoding.
+        With cache=True (default: as the VideoData) the trace is read
+        from / saved to trace_path()
+        '''
+        if self.trace is not None:
+            return self.trace
+
+        if cache is None:
+            cache = self.cache
+
+        path = self.trace_path()
+        if cache and os.path.exists(path):
+            self.trace = np.load(path, mmap_mode='r')
+            return self.trace
+
+        n_frame = self.metadata['n_frame']
+        frames = self.iter_frames(0, (n_frame + 1) / self.fr)
+
+        self.trace = np.stack(self.reduce_flow(frames, pbar))
+
+        if cache:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
 
-        delta = compute_flow(frames)
-        dx_bar, dy_bar = average_flow(delta, self.flip_x, self.flip_y)
+                with atomic_path(path) as tmp_path, open(tmp_path, 'wb') as f:
+                    np.save(f, self.trace)
+            except OSError as e:
+                print(f'⚠️ Warning: cannot write motion trace cache {path}: {e}')
 
-        return MotionData(dx_bar, dy_bar, self.dt)
+        return self.trace
+
+    def iter_frames(self, start, end):
+        # sampled frames from start (sec) to end (sec), see iter_frames
+        if self.reader is not None:
+            return self.reader.frames(start, end, self.step, self.fr)
+
+        return iter_frames(self.video, start, end, self.step, self.fr,
+                           keyframes=self.seek_keyframes(start))
+
+    def seek_keyframes(self, start):
+        '''
+        Keyframe numbers for a read from start (sec). The index (a scan of
+        the whole file, kept as a sidecar) is only loaded once a read has
+        to seek: sequential reads (trace mode) and the ffmpeg backend
+        never need it
+        '''
+        if self.keyframes is not None or not self.use_keyframes:
+            return self.keyframes
+        if int(start * self.fr) == int(self.video.get(cv2.CAP_PROP_POS_FRAMES)):
+            return None
+
+        return self.keyframe_index()
+
+    def keyframe_index(self):
+        '''
+        Keyframe numbers of the file read, loaded (or scanned) now; None
+        without keyframes or with the ffmpeg backend, which seeks itself
+        '''
+        if self.keyframes is None and self.use_keyframes and self.reader is None:
+            index = load_keyframes(self.proxy_path or self.video_path,
+                                   cache_dir=self.cache_dir)
+            self.keyframes = index['frame']
+        return self.keyframes
+
+    def reduce_flow(self, frames, pbar=False):
+        # per-pair mean motion of raw frames, pipelined if n_thread > 1
+        if self.n_thread > 1:
+            return pipeline_flow(frames, self.sample, self.flip_x, self.flip_y,
+                                 pbar, self.method, self.n_thread,
+                                 crop=self.flow_crop, mask=self.flow_mask,
+                                 gate=self.gate)
+
+        return stream_flow(frames, self.sample, self.flip_x, self.flip_y,
+                           pbar, self.method, self.flow_crop, self.flow_mask,
+                           self.gate)
+
+    def open_proxy(self):
+        '''
+        Switch to the proxy of the video if there is an up-to-date one.
+        Crops are cut before resizing, so they always use the video
+        '''
+        path = proxy_path(self.video_path, self.dsp)
+        if self.crop is not None or not os.path.exists(path):
+            return False
+
+        if os.path.getmtime(path) < os.path.getmtime(self.video_path):
+            print(f'⚠️ Warning: proxy {path} is older than the video, not used.')
+            return False
+
+        video = cv2.VideoCapture(path)
+        n_frame = self.metadata['n_frame']
+        if not video.isOpened() or video.get(cv2.CAP_PROP_FRAME_COUNT) != n_frame:
+            print(f'⚠️ Warning: proxy {path} does not match the video, not used.')
+            video.release()
+            return False
+
+        self.video.release()
+        self.video = video
+        self.proxy_path = path
+        self.sample = 1.0
+        self.flow_mask = scale_mask(self.mask, None, self.dsp)
+        return True
+
+    def load_roi(self, crop=None, mask=None):
+        if isinstance(mask, str) and mask == 'auto':
+            auto_crop, mask = detect_roi(self.video, self.dsp)
+            if mask is None:
+                print('⚠️ Warning: no motion region detected, using the whole frame.')
+            elif crop is None:
+                crop = auto_crop
+
+        elif isinstance(mask, str):
+            image = cv2.imread(mask, cv2.IMREAD_GRAYSCALE)
+            if image is None:
+                raise ValueError(f"Error: Cannot read mask image {mask}.")
+            mask = image
+
+        width, height = self.metadata['width'], self.metadata['height']
+        if mask is not None:
+            mask = np.asarray(mask) > 0
+            if mask.shape != (height, width):
+                raise ValueError("Error: Mask does not match the video frame size.")
+
+        if crop is not None:
+            crop = tuple(int(c) for c in crop)
+            x, y, w, h = crop
+            if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > width or y + h > height:
+                raise ValueError("Error: Crop is outside the video frame.")
+
+        return crop, mask
+
+    def trace_path(self):
+        '''
+        Cache file of the motion trace, keyed by the video identity
+        (resolved path, size, mtime) and the flow settings
+        '''
+        real_path = os.path.realpath(self.video_path)
+        stat = os.stat(real_path)
+
+        key = '%s|%d|%d|%s|%d|%d|%d|%d|%s' % (real_path, stat.st_size,
+                                              stat.st_mtime_ns, repr(self.dsp),
+                                              self.step, self.fr,
+                                              self.flip_x, self.flip_y,
+                                              self.method)
+        if self.gate is not None:
+            key += '|gate=%r' % self.gate.threshold
+        if self.reader is not None:
+            key += '|ffmpeg'
+        if self.crop is not None:
+            key += '|crop=%d,%d,%d,%d' % self.crop
+        if self.mask is not None:
+            key += '|mask=' + hashlib.sha1(np.packbits(self.mask)).hexdigest()
+        key = hashlib.sha1(key.encode()).hexdigest()[:16]
+
+        cache_dir = self.cache_dir or os.path.dirname(real_path)
+        name = os.path.basename(real_path)[:-4]
+        return os.path.join(cache_dir, f'{name}_trace_{key}.npy')
+
+    def trace_window(self, start, length):
+        '''
+        Flow of the sampled frames (k + 1) * step - 1 falling inside
+        [start, start + length), and the time (sec) their first frame is
+        read after the first frame get_frames would read from start
+        (start_index + step - 1), to shift the motion time axis by: the
+        trace is sampled on the global step grid, not from start_index
+        '''
+        start_index = int(start * self.fr)
+        end_index = start_index + int(length * self.fr)
+
+        j0 = max(-(-(start_index + 1) // self.step) - 1, 0)
+        j1 = min(end_index // self.step - 1, self.trace.shape[1])
+        shift = ((j0 + 1) * self.step - 1 - (start_index + self.step - 1)) / self.fr
+
+        return self.trace[0, j0:j1], self.trace[1, j0:j1], shift
 
     def get_frame(self, t):
         return int(t * self.fr)
@@ -92,24 +462,48 @@ class VideoData():
         self.video.release()
 
 class ZaberData():
-    def __init__(self, data_path):
-        data_frame = pd.read_csv(data_path, low_memory=False)
+    def __init__(self, data_path, cache=True, cache_dir=None):
+        # only the needed columns, from the sidecar cache (see flow.params)
+        params = load_params(data_path, cache=cache, cache_dir=cache_dir)
 
         ZABER_TO_MM = 508 / 72248
-        zaber_x = data_frame['zaber_x'].to_numpy() * ZABER_TO_MM
-        zaber_y = data_frame['zaber_y'].to_numpy() * ZABER_TO_MM
-        self.zaber_t = data_frame['relative_time'].to_numpy()
+        zaber_x = params['zaber_x'] * ZABER_TO_MM
+        zaber_y = params['zaber_y'] * ZABER_TO_MM
+        self.zaber_t = params['relative_time']
 
         self.dx_zaber = np.diff(zaber_x)
         self.dy_zaber = np.diff(zaber_y)
 
+        # cumulative count of samples where the stage moves, see activity
+        moving = (self.dx_zaber != 0) | (self.dy_zaber != 0)
+        self.n_moving = np.concatenate([[0], np.cumsum(moving)])
+
+    def activity(self, t, window):
+        '''
+        Fraction of zaber samples in [t, t + window) where the stage
+        moves, for a scalar or an array of start times t
+        '''
+        n_diff = len(self.dx_zaber)
+        i0 = np.minimum(np.searchsorted(self.zaber_t, t), n_diff)
+        i1 = np.minimum(np.searchsorted(self.zaber_t, np.add(t, window)), n_diff)
+
+        return (self.n_moving[i1] - self.n_moving[i0]) / np.maximum(i1 - i0, 1)
+
+    def most_active(self, window, t_start, t_end):
+        '''
+        Start time in [t_start, t_end] of the window with the most
+        stage movement (on a grid of window / 4)
+        '''
+        grid = np.arange(t_start, max(t_end, t_start) + 1e-9, window / 4)
+        return float(grid[np.argmax(self.activity(grid, window))])
+
     def get_motion(self, start, length):
         # find t0 in zaber_t cloest to start
-        t0_index = np.argmin(np.abs(self.zaber_t - start))
+        t0_index = self.get_index(start)
         t0 = self.zaber_t[t0_index]
 
         # find t1 in zaber_t cloest to start
-        t1_index = np.argmin(np.abs(self.zaber_t - (start + length)))
+        t1_index = self.get_index(start + length)
         t1 = self.zaber_t[t1_index]
 
         dx = self.dx_zaber[t0_index:t1_index]
@@ -120,45 +514,172 @@ class ZaberData():
 
     def get_frame(self, t):
         # find t0 in zaber_t cloest to start
-        index = int(np.argmin(np.abs(self.zaber_t - t)))
+        index = self.get_index(t)
         return index, self.zaber_t[index]
 
-def compute_lag(zaber_path, video_path, t0, length, init=0):
-    zaber = ZaberData(zaber_path)
-    zaber_motion, t0, t1 = zaber.get_motion(start=t0, length=length)
+    def get_index(self, t):
+        '''
+        Index of the zaber sample closest to t (binary search on the
+        sorted timeline, ties resolved to the earlier sample as np.argmin)
+        '''
+        right = int(np.searchsorted(self.zaber_t, t))
+        right = min(max(right, 1), len(self.zaber_t) - 1)
+        left = right - 1
 
-    video = VideoData(video_path, step=4)
-    optical_flow = video.get_motion(start=t0+init, length=t1-t0)
+        if t - self.zaber_t[left] <= self.zaber_t[right] - t:
+            return left
+        return right
+
+class FrameLog():
+    '''
+    Hardware log of the HS camera frames (hs_cam_frames CSV): the time
+    of each logged frame on the zaber clock (relative_time), and its
+    frame number (the row order, unless frame_column is given)
+    '''
+    def __init__(self, log_path, time_column='relative_time',
+                 frame_column=None, fr=120):
+        data_frame = pd.read_csv(log_path)
+        for column in [time_column, frame_column]:
+            if column is not None and column not in data_frame:
+                raise ValueError(f"Error: No column '{column}' in frame log "
+                                 f"(columns: {', '.join(data_frame.columns)}).")
 
-    # compute lag using cross-correlation
-    corr, lags = cross_correlate(optical_flow, zaber_motion, combine=True)
-    corr_val = np.max(corr)
-    lag = init + float(lags[np.argmax(corr)])
+        self.t = data_frame[time_column].to_numpy(dtype=float)
+        if frame_column is None:
+            self.frame = np.arange(len(self.t))
+        else:
+            self.frame = data_frame[frame_column].to_numpy(dtype=int)
+        self.fr = fr
 
-    # seek the corresponding video and zaber frame
-    zaber_index, zaber_time = zaber.get_frame(t0 - lag)
-    video_index = video.get_frame(zaber_time + lag)
+    def lag(self, t=None):
+        '''
+        Lag (video time - zaber time) of the logged frames, or at zaber
+        times t (linear interpolation, constant outside the log)
+        '''
+        lag = self.frame / self.fr - self.t
+        if t is None:
+            return lag
+        return np.interp(t, self.t, lag)
 
-    video.release()
-    return lag, video_index, zaber_index, corr_val
+class CalibrationSession():
+    '''
+    Hold one parsed zaber timeline and one open video handle,
+    so that repeated lag estimates do not reload either of them
+    '''
+    def __init__(self, zaber_path, video_path, step=4, dsp=0.25, cache=True,
+                 cache_dir=None, method='farneback', n_thread=1,
+                 subsample=False, zaber=None, crop=None, mask=None,
+                 backend='opencv', gate=None, keyframes=True):
+        # an already parsed ZaberData can be shared instead of zaber_path
+        self.zaber = ZaberData(zaber_path) if zaber is None else zaber
 
-def calib_video_init(zaber_path, video_path, window=45):
-    """Run initial lag estimate only. Returns (init_lag, init_window, t_max) or None."""
-    # find the maximum length
-    zaber = ZaberData(zaber_path)
-    zaber_max = zaber.zaber_t[-1]
+        # subsample: parabolic peak interpolation of the lag, so the lag
+        # is not limited to multiples of the sampling interval (step / fr)
+        self.subsample = subsample
+
+        self.video_path = video_path
+        self.video_kwargs = dict(step=step, dsp=dsp, cache=cache,
+                                 cache_dir=cache_dir, method=method,
+                                 n_thread=n_thread, backend=backend, gate=gate)
+        # keyframes: an already loaded keyframe array can be shared too,
+        # it is only valid for this video and dsp, so not kept in video_kwargs
+        self.video = VideoData(video_path, crop=crop, mask=mask,
+                               keyframes=keyframes, **self.video_kwargs)
+
+        # resolved once (mask='auto' is detected here), workers reuse it
+        self.video_kwargs.update(crop=self.video.crop, mask=self.video.mask)
+
+    def compute_lag(self, t0, length, init=0, max_lag=None):
+        zaber, video = self.zaber, self.video
+        zaber_motion, t0, t1 = zaber.get_motion(start=t0, length=length)
+        optical_flow = video.get_motion(start=t0+init, length=t1-t0)
+
+        # compute lag using cross-correlation
+        corr, lags = cross_correlate(optical_flow, zaber_motion,
+                                     combine=True, max_lag=max_lag)
+        lag, corr_val = peak_lag(corr, lags, self.subsample)
+        lag = init + lag
+
+        # seek the corresponding video and zaber frame
+        zaber_index, zaber_time = zaber.get_frame(t0 - lag)
+        video_index = video.get_frame(zaber_time + lag)
+
+        return lag, video_index, zaber_index, corr_val
+
+    def compute_lags(self, t0, length, init=0, max_lag=None):
+        '''
+        Lag estimates for all anchors t0 in one batch, read from the
+        whole-session motion trace (loaded on first use)
+        '''
+        zaber, video = self.zaber, self.video
+        if video.trace is None:
+            video.load_trace(pbar=True)
+
+        fs, gs, t_zaber = [], [], []
+        for t in t0:
+            zaber_motion, t_start, t_end = zaber.get_motion(start=t, length=length)
+            fs.append(video.get_motion(start=t_start+init, length=t_end-t_start))
+            gs.append(zaber_motion)
+            t_zaber.append(t_start)
+
+        # compute lag using batched cross-correlation
+        corr, lags = cross_correlate_batch(fs, gs, max_lag)
+        all_lag, corr_val = peak_lag(corr, lags, self.subsample)
+        all_lag = init + all_lag
+
+        # seek the corresponding video and zaber frame
+        video_index = np.zeros(len(t0), dtype=int)
+        zaber_index = np.zeros(len(t0), dtype=int)
+        for i, t in enumerate(t_zaber):
+            zaber_index[i], zaber_time = zaber.get_frame(t - all_lag[i])
+            video_index[i] = video.get_frame(zaber_time + all_lag[i])
+
+        return [all_lag, video_index, zaber_index, corr_val]
 
-    video = VideoData(video_path, step=4)
-    video_max = video.video.get(cv2.CAP_PROP_FRAME_COUNT) / video.fr
-    video.release()
-    t_max = min(zaber_max, video_max) - window * 2
+    def t_max(self, window):
+        # maximum anchor time covered by both zaber and video
+        zaber_max = self.zaber.zaber_t[-1]
+        video_max = self.video.metadata['n_frame'] / self.video.fr
+        return min(zaber_max, video_max) - window * 2
+
+    def release(self):
+        self.video.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+def compute_lag(zaber_path, video_path, t0, length, init=0, max_lag=None):
+    with CalibrationSession(zaber_path, video_path) as session:
+        return session.compute_lag(t0, length, init, max_lag)
+
+def calib_video_init(zaber_path, video_path, window=45, session=None,
+                     search='coarse'):
+    """Run initial lag estimate only. Returns (init_lag, init_window, t_max) or None.
+
+    search: 'coarse' for the coarse-to-fine search (calib_video_coarse),
+    'double' for the legacy window doubling from `window` up to 720 s
+    """
+    if session is None:
+        with CalibrationSession(zaber_path, video_path) as session:
+            return calib_video_init(zaber_path, video_path, window,
+                                    session, search)
+
+    if search == 'coarse':
+        init_lag, init_window, t_max, _ = calib_video_coarse(session, window)
+        return init_lag, init_window, t_max
+
+    # find the maximum length
+    t_max = session.t_max(window)
 
     # initial guess
     run_flag = True
     init_max = 720
     init_window = window
     while run_flag:
-        init_lag, _, _, corr = compute_lag(zaber_path, video_path, 0, init_window)
+        init_lag, _, _, corr = session.compute_lag(0, init_window)
         if corr >= 0.50:
             run_flag = False
 
@@ -174,18 +695,179 @@ def calib_video_init(zaber_path, video_path, window=45):
     print('Initial Lag: %.3f (sec);' % init_lag, 'Correlation: %.3f' % corr)
     return init_lag, init_window, t_max
 
-def calib_video(zaber_path, video_path,
-                n_point=60, window=45,
-                exclude=True, pbar=True):
+def calib_video_coarse(session, window=45, span=720, step=16, dsp=0.0625,
+                       band=1.0, threshold=0.50):
+    '''
+    Coarse-to-fine initial lag estimate with a bounded cost:
+    1) coarse: global lag search over the first `span` seconds at low
+       temporal (step) and spatial (dsp) resolution
+    2) fine: refine at full resolution over the first `window` seconds,
+       searching only within +/- band (sec) around the coarse lag
+
+    Returns (init_lag, init_window, t_max, stage) where stage is the
+    last stage that reached `threshold` correlation: 'fine', 'coarse'
+    or 'failed'
+    '''
+    t_max = session.t_max(window)
+    span = max(min(span, t_max + window), window)
+
+    # coarse stage, from the full-resolution trace if it is loaded
+    if session.video.trace is not None:
+        coarse_lag, _, _, coarse_corr = session.compute_lag(0, span)
+    else:
+        coarse_kwargs = dict(session.video_kwargs, step=step, dsp=dsp,
+                             n_thread=1)
+        with CalibrationSession(None, session.video_path, zaber=session.zaber,
+                                subsample=session.subsample,
+                                **coarse_kwargs) as coarse:
+            coarse_lag, _, _, coarse_corr = coarse.compute_lag(0, span)
+    print(f'Coarse lag estimate {coarse_lag:.3f} over {span:.0f} seconds, '
+          f'correlation {coarse_corr:.3f}')
+
+    # fine stage, on the window with the most stage movement
+    t_fine = session.zaber.most_active(window, 0, span - window)
+    init_lag, _, _, corr = session.compute_lag(t_fine, window, coarse_lag, band)
+    if corr >= threshold:
+        stage = 'fine'
+    elif coarse_corr >= threshold:
+        print(f'Fine lag estimate {init_lag:.3f}, correlation {corr:.3f} '
+              'is too low, using the coarse estimate')
+        init_lag, corr, stage = coarse_lag, coarse_corr, 'coarse'
+    else:
+        print('⚠️ Warning: initial calibration did not find good correlation.')
+        if coarse_corr > corr:
+            init_lag, corr = coarse_lag, coarse_corr
+        stage = 'failed'
 
-    result = calib_video_init(zaber_path, video_path, window)
-    if result is None:
-        return None
-    init_lag, init_window, t_max = result
+    print('Initial Lag: %.3f (sec);' % init_lag, 'Correlation: %.3f;' % corr,
+          'Stage: %s' % stage)
+    return init_lag, window, t_max, stage
 
-    # run calibration along anchor points t0
-    t0 = np.linspace(init_window, t_max, n_point)
+def place_anchors(zaber, t_start, t_max, n_point, window, min_activity=0.1):
+    '''
+    Anchor points t0 in [t_start, t_max], spread evenly over the windows
+    where the zaber stage moves in at least min_activity of the samples,
+    so that no flow is computed on windows with an idle stage
+    '''
+    n_grid = max(4 * n_point, int((t_max - t_start) / (window / 4)) + 1)
+    grid = np.linspace(t_start, t_max, n_grid)
+    active = grid[zaber.activity(grid, window) >= min_activity]
+    print('%d of %d candidate window(s) with idle stage (activity < %.2f)' % \
+          (n_grid - len(active), n_grid, min_activity))
+
+    if len(active) == 0:
+        print('⚠️ Warning: no active window found, placing anchors uniformly.')
+        return np.linspace(t_start, t_max, n_point)
 
+    if len(active) <= n_point:
+        return active
+
+    return active[np.round(np.linspace(0, len(active) - 1,
+                                       n_point)).astype(int)]
+
+def n_worker():
+    '''
+    Number of worker processes: the LSF slot allocation of the job
+    (bsub -n) if available, otherwise the CPUs usable by this process
+    '''
+    for key in ['LSB_DJOB_NUMPROC', 'LSB_MAX_NUM_PROCESSORS']:
+        if os.environ.get(key, '').isdigit():
+            return int(os.environ[key])
+
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# session of a worker process, see calib_anchor
+_worker_session = None
+
+def _init_worker(zaber, video_path, video_kwargs, subsample):
+    global _worker_session
+    # one process per slot, avoid oversubscribing with OpenCV threads
+    cv2.setNumThreads(1)
+    _worker_session = CalibrationSession(None, video_path, zaber=zaber,
+                                         subsample=subsample, **video_kwargs)
+
+def _worker_lag(args):
+    # frame pairs gated in this call are sent back with the result
+    gate = _worker_session.video.gate
+    if gate is None:
+        return _worker_session.compute_lag(*args), None
+
+    n_pair, n_skip = gate.n_pair, gate.n_skip
+    result = _worker_session.compute_lag(*args)
+    return result, (gate.n_pair - n_pair, gate.n_skip - n_skip)
+
+CHECKPOINT_COLUMNS = ['t0', 'window', 'init_lag', 'max_lag', 'lag',
+                      'video_index', 'zaber_index', 'correlation']
+
+def load_checkpoint(checkpoint, t0, window, init_lag, max_lag=None):
+    '''
+    Anchors of t0 already in the partial results file, computed with the
+    same window, init_lag and max_lag. Returns the indices into t0 and
+    the matching calibration rows
+    '''
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return np.array([], dtype=int), []
+
+    # a job killed while appending may leave a truncated last line, which
+    # can still parse (e.g. a shorter correlation): only complete lines
+    with open(checkpoint) as f:
+        content = f.read()
+    content = content[:content.rfind('\n') + 1]
+    if content.count('\n') < 2:
+        return np.array([], dtype=int), []
+
+    partial = pd.read_csv(io.StringIO(content), on_bad_lines='skip')
+    partial = partial.dropna(subset=['t0', 'lag', 'correlation'])
+
+    same = np.isclose(partial['window'], window) & \
+        np.isclose(partial['init_lag'], init_lag)
+    if max_lag is None:
+        same &= partial['max_lag'].isna()
+    else:
+        same &= np.isclose(partial['max_lag'], max_lag)
+    partial = partial[same]
+
+    index, rows = [], []
+    for i, t in enumerate(t0):
+        match = np.where(np.isclose(partial['t0'], t))[0]
+        if len(match) > 0:
+            row = partial.iloc[match[-1]]
+            index.append(i)
+            rows.append((row['lag'], int(row['video_index']),
+                         int(row['zaber_index']), row['correlation']))
+
+    return np.array(index, dtype=int), rows
+
+def append_checkpoint(checkpoint, t0, window, init_lag, max_lag, result):
+    # one line per anchor, flushed so a killed job keeps finished anchors
+    values = [t0, window, init_lag, max_lag, *result]
+    line = ','.join('' if v is None else repr(float(v)) for v in values) + '\n'
+    with open(checkpoint, 'a+b') as f:
+        # drop a line truncated by a killed job (that anchor is computed
+        # again), rather than ending it and keeping a cut value
+        f.seek(0)
+        end = f.read().rfind(b'\n') + 1
+        f.truncate(end)
+        if end == 0:
+            f.write((','.join(CHECKPOINT_COLUMNS) + '\n').encode())
+        f.write(line.encode())
+        f.flush()
+
+def calib_anchor(session, t0, window, init_lag, pbar=True, max_lag=None,
+                 n_worker=1, checkpoint=None):
+    '''
+    Run lag estimate along anchor points t0 with a shared session,
+    searching lags within init_lag +/- max_lag (sec) if given
+
+    n_worker > 1 spreads the anchors over a process pool; each worker
+    opens its own video handle and shares the parsed zaber data, and
+    the results are collected in anchor order
+
+    checkpoint: partial results file; every anchor is appended to it as
+    it finishes, and anchors already in it are not computed again
+    '''
     all_lag = np.zeros_like(t0, dtype=float)
     video_index = np.zeros_like(t0, dtype=int)
     zaber_index = np.zeros_like(t0, dtype=int)
@@ -193,11 +875,286 @@ def calib_video(zaber_path, video_path,
     calibration = [all_lag, video_index,
                    zaber_index, corr_val]
 
-    for i in tqdm(range(len(t0)), disable=not pbar, miniters=5):
-        # compute lag, video frame and the corresponding zaber frame
-        calib_result = compute_lag(zaber_path, video_path, t0[i], window, init_lag)
+    done, rows = load_checkpoint(checkpoint, t0, window, init_lag, max_lag)
+    for i, row in zip(done, rows):
         for j in range(len(calibration)):
-            calibration[j][i] = calib_result[j]
+            calibration[j][i] = row[j]
+    if len(done) > 0:
+        print(f'Resuming: {len(done)}/{len(t0)} anchor(s) from {checkpoint}')
+
+    todo = np.setdiff1d(np.arange(len(t0)), done)
+    if len(todo) == 0:
+        return calibration
+
+    if n_worker > 1:
+        # the keyframe index is loaded (or scanned) once here and passed
+        # on, instead of every worker scanning the video on its first seek
+        video_kwargs = dict(session.video_kwargs)
+        keyframes = session.video.keyframe_index()
+        if keyframes is not None:
+            video_kwargs.update(keyframes=keyframes)
+
+        pool = multiprocessing.Pool(min(n_worker, len(todo)), _init_worker,
+                                    (session.zaber, session.video_path,
+                                     video_kwargs, session.subsample))
+        anchors = [(t0[i], window, init_lag, max_lag) for i in todo]
+        results = pool.imap(_worker_lag, anchors)
+    else:
+        pool = None
+        results = ((session.compute_lag(t0[i], window, init_lag, max_lag), None)
+                   for i in todo)
+
+    try:
+        for i in tqdm(todo, disable=not pbar, miniters=5):
+            # compute lag, video frame and the corresponding zaber frame
+            calib_result, gate_count = next(results)
+            if gate_count is not None:
+                session.video.gate.add(*gate_count)
+            for j in range(len(calibration)):
+                calibration[j][i] = calib_result[j]
+
+            if checkpoint is not None:
+                append_checkpoint(checkpoint, t0[i], window, init_lag,
+                                  max_lag, calib_result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return calibration
+
+def calib_adaptive(session, t_start, t_max, window, init_lag, n_init=8,
+                   n_max=60, tol=None, min_gap=None, threshold=0.30,
+                   pbar=True, max_lag=None, n_worker=1, trace=False,
+                   checkpoint=None):
+    '''
+    Adaptive anchor refinement: start with n_init uniform anchors, model
+    the lag as piecewise-linear in t0 (linear between anchors), and add
+    an anchor in the middle of every interval where either anchor
+    deviates by more than tol (sec, default 1.5 samples) from the line
+    through its neighbours, or has correlation below threshold, until no
+    interval needs refinement, n_max anchors are used, or the intervals
+    are shorter than min_gap (default window / 2). A linear drift needs
+    no refinement
+
+    checkpoint: partial results file, see calib_anchor
+    '''
+    # above one lag step, so quantisation alone never splits
+    tol = 1.5 * session.video.dt if tol is None else tol
+    min_gap = window / 2 if min_gap is None else min_gap
+
+    def evaluate(t0):
+        if trace:
+            return session.compute_lags(t0, window, init_lag, max_lag)
+        return calib_anchor(session, t0, window, init_lag, pbar,
+                            max_lag, n_worker, checkpoint)
+
+    t0 = np.linspace(t_start, t_max, n_init)
+    calibration = evaluate(t0)
+
+    while len(t0) < n_max:
+        lag, corr = calibration[0], calibration[3]
+
+        # anchors off the piecewise-linear model of their neighbours
+        bad = corr < threshold
+        inner_lag = lag[:-2] + (lag[2:] - lag[:-2]) * \
+            (t0[1:-1] - t0[:-2]) / (t0[2:] - t0[:-2])
+        bad[1:-1] |= np.abs(lag[1:-1] - inner_lag) > tol
+
+        # intervals to split: an end anchor off the model
+        split = bad[:-1] | bad[1:]
+        split &= np.diff(t0) >= 2 * min_gap
+
+        t_new = ((t0[:-1] + t0[1:]) / 2)[split]
+        if len(t_new) == 0:
+            break
+        t_new = t_new[:n_max - len(t0)]
+        print(f'Adding {len(t_new)} anchor(s) to {len(t0)}')
+
+        # merge new anchors, keep t0 sorted
+        new_calibration = evaluate(t_new)
+        t0 = np.concatenate([t0, t_new])
+        order = np.argsort(t0)
+        t0 = t0[order]
+        calibration = [np.concatenate([c, n])[order] for c, n in
+                       zip(calibration, new_calibration)]
+
+    return t0, calibration
+
+def calib_video_log(session, log, window=45, n_point=60, n_verify=5,
+                    band=0.5, tol=None, threshold=0.30, pbar=True):
+    '''
+    Calibration from the hardware frame log: the lag of every anchor is
+    read from the log, and optical flow only runs at n_verify anchors,
+    searching the logged lag +/- band (sec). Their median difference to
+    the log (a constant clock offset) is added to all anchors; the
+    correlation of an anchor is that of the nearest verification anchor
+
+    Returns (t0, calibration, status) with t0 and calibration as from
+    calib_anchor if status is 'verified'. Otherwise they are None, and
+    status is 'failed' if fewer than half of the verification anchors
+    correlate (>= threshold), or 'drift' if their differences to the log
+    spread by more than tol (default 2 samples)
+    '''
+    zaber, video = session.zaber, session.video
+    tol = 2 * video.dt if tol is None else tol
+
+    t_start = max(log.t[0], zaber.zaber_t[0])
+    t_end = min(log.t[-1], session.t_max(window))
+    if t_end <= t_start:
+        print('⚠️ Warning: frame log does not overlap the zaber data.')
+        return None, None, 'failed'
+
+    # optical flow at a few verification anchors
+    t_verify = np.linspace(t_start, t_end, n_verify)
+    residual = np.zeros(n_verify)
+    corr = np.zeros(n_verify)
+    for i in tqdm(range(n_verify), disable=not pbar):
+        log_lag = log.lag(t_verify[i])
+        lag, _, _, corr[i] = session.compute_lag(t_verify[i], window, log_lag,
+                                                 band)
+        residual[i] = lag - log_lag
+
+    good = corr >= threshold
+    if np.sum(good) < max(n_verify / 2, 1):
+        print('⚠️ Warning: frame log verification failed, '
+              '%d/%d anchors correlate.' % (np.sum(good), n_verify))
+        return None, None, 'failed'
+
+    offset = np.median(residual[good])
+    spread = np.max(np.abs(residual[good] - offset))
+    print('Frame log offset %.4f (sec), spread %.4f over %d anchors' % \
+          (offset, spread, np.sum(good)))
+    if spread > tol:
+        print('⚠️ Warning: frame log verification failed, lags off by up '
+              'to %.3f sec.' % spread)
+        return None, None, 'drift'
+
+    # all anchors from the log, same frame lookup as compute_lag
+    t0 = np.linspace(t_start, t_end, n_point)
+    all_lag = np.zeros(n_point)
+    video_index = np.zeros(n_point, dtype=int)
+    zaber_index = np.zeros(n_point, dtype=int)
+    for i, t in enumerate(t0):
+        t_zaber = zaber.zaber_t[zaber.get_index(t)]
+        all_lag[i] = log.lag(t_zaber) + offset
+        zaber_index[i], zaber_time = zaber.get_frame(t_zaber - all_lag[i])
+        video_index[i] = video.get_frame(zaber_time + all_lag[i])
+
+    nearest = np.argmin(np.abs(t0[:, None] - t_verify[None, :]), axis=1)
+    corr_val = np.where(good, corr, 0)[nearest]
+
+    return t0, [all_lag, video_index, zaber_index, corr_val], 'verified'
+
+def frame_log_init(session, log, window=45):
+    '''
+    Initial lag and search band from the frame log, in place of
+    calib_video_init. Returns (init_lag, init_window, t_max, max_lag)
+    '''
+    lag = log.lag()
+    init_lag = float(np.median(lag))
+
+    # drift of the lag over the session, plus the lag resolution
+    max_lag = float(np.max(np.abs(lag - init_lag))) + 2 * session.video.dt
+    init_window = max(log.t[0], session.zaber.zaber_t[0], 0)
+    print('Initial Lag: %.3f (sec) +/- %.3f from the frame log' % \
+          (init_lag, max_lag))
+
+    return init_lag, init_window, session.t_max(window), max_lag
+
+def calib_video(zaber_path, video_path,
+                n_point=60, window=45,
+                exclude=True, pbar=True, trace=False, max_lag=None,
+                method='farneback', n_worker=1, n_thread=1, search='coarse',
+                step=4, subsample=False, placement='uniform', min_activity=0.1,
+                adaptive=False, n_init=8, tol=None, crop=None, mask=None,
+                backend='opencv', gate=None, frame_log=None, n_verify=5):
+    '''
+    trace: decode the video once into a whole-session motion trace and
+    score all anchors from it in one batch, instead of seeking and
+    computing flow for each anchor window
+
+    max_lag: search anchor lags only within init_lag +/- max_lag (sec)
+    method: global motion estimator, see flow.compute.MOTION_ESTIMATORS
+    n_worker: number of processes for the anchor points
+    n_thread: number of threads pipelining decoding and flow in a window
+    search: initial lag search, 'coarse' (coarse-to-fine) or 'double'
+    step: temporal sampling of the video frames
+    subsample: sub-sample (parabolic) lag refinement, for coarser steps
+    placement: 'uniform' anchors, or 'active' to place anchors only on
+    windows where the stage moves (see place_anchors)
+    adaptive: start from n_init anchors and refine where the lag model
+    is off by more than tol (see calib_adaptive), n_point is the maximum
+    crop: (x, y, w, h) region of the video used for optical flow
+    mask: pixels averaged into the global motion (boolean array in video
+    pixels, mask image path, or 'auto' to detect the moving region)
+    backend: 'opencv' or 'ffmpeg' to decode, select and resize frames in
+    an ffmpeg process (see flow.compute.FFmpegReader)
+    gate: record zero motion without running optical flow on frame pairs
+    differing by less than gate gray levels on average (see FrameGate)
+    frame_log: hs_cam_frames CSV (or FrameLog) of the session; anchor lags
+    are read from it and verified with optical flow at n_verify anchors
+    (see calib_video_log); if they drift off the log, it still replaces
+    the initial lag search and bounds the anchor search band
+    '''
+    with CalibrationSession(zaber_path, video_path, step=step, method=method,
+                            n_thread=n_thread, subsample=subsample,
+                            crop=crop, mask=mask, backend=backend,
+                            gate=gate) as session:
+        # hardware frame log: lags from the log, checked at a few anchors
+        status = None
+        if frame_log is not None:
+            try:
+                if not isinstance(frame_log, FrameLog):
+                    frame_log = FrameLog(frame_log)
+                t0, calibration, status = calib_video_log(session, frame_log,
+                                                          window, n_point,
+                                                          n_verify, pbar=pbar)
+            except Exception as e:
+                # an unreadable log falls back to the search from the video
+                print(f'⚠️ Warning: cannot use frame log: {e}')
+                status = 'failed'
+
+        if status != 'verified':
+            if trace:
+                session.video.load_trace(pbar)
+
+            if status == 'drift':
+                # close but not within tol, the log still gives the lag
+                # and bounds the search band
+                init_lag, init_window, t_max, log_band = \
+                    frame_log_init(session, frame_log, window)
+                max_lag = log_band if max_lag is None else max_lag
+            else:
+                result = calib_video_init(zaber_path, video_path, window,
+                                          session, search)
+                if result is None:
+                    return None
+                init_lag, init_window, t_max = result
+
+            # run calibration along anchor points t0
+            if adaptive:
+                t0, calibration = calib_adaptive(session, init_window, t_max,
+                                                 window, init_lag, n_init,
+                                                 n_point, tol, pbar=pbar,
+                                                 max_lag=max_lag,
+                                                 n_worker=n_worker, trace=trace)
+            else:
+                if placement == 'active':
+                    t0 = place_anchors(session.zaber, init_window, t_max,
+                                       n_point, window, min_activity)
+                else:
+                    t0 = np.linspace(init_window, t_max, n_point)
+
+                if trace:
+                    calibration = session.compute_lags(t0, window, init_lag,
+                                                       max_lag)
+                else:
+                    calibration = calib_anchor(session, t0, window, init_lag,
+                                               pbar, max_lag, n_worker)
+
+        if session.video.gate is not None:
+            session.video.gate.report()
 
     # exclude outliers
     if exclude:
@@ -1,18 +1,39 @@
+import os
 import cv2
+import queue
+import shutil
+import subprocess
+import threading
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from .atomic import atomic_path
+from .keyframes import seek_frame
+from .metadata import load_metadata
 
-def get_frames(video, start, end, sample=1.0, step=1, fr=120):
+def iter_frames(video, start, end, step=1, fr=120, decimate=True,
+                keyframes=None):
     '''
-    Get frames from start (sec) to end (sec) from the video
+    Yield raw frames from start (sec) to end (sec) from the video,
+    keeping one of every `step` frames
+
+    With decimate=True, skipped frames are only grabbed (demuxed and
+    decoded) and never retrieved, which saves the BGR conversion and
+    copy of every frame that is thrown away
+
+    keyframes: keyframe numbers of the video (see flow.keyframes), used
+    to seek to the previous keyframe and decode forward from there
     '''
     start_index = int(start * fr)
-    video.set(cv2.CAP_PROP_POS_FRAMES, start_index)
+    seek_frame(video, start_index, keyframes)
 
-    frames = []
     counter = 0
     for _ in range(int((end - start) * fr)):
-        ret, frame = video.read()
+        if decimate:
+            ret = video.grab()
+        else:
+            ret, frame = video.read()
         if not ret:
             break
 
@@ -22,7 +43,20 @@ def get_frames(video, start, end, sample=1.0, step=1, fr=120):
         else:
             continue
 
-        frames.append(convert_frame(frame, sample))
+        if decimate:
+            ret, frame = video.retrieve()
+            if not ret:
+                break
+
+        yield frame
+
+def get_frames(video, start, end, sample=1.0, step=1, fr=120, decimate=True,
+               crop=None, keyframes=None):
+    '''
+    Get frames from start (sec) to end (sec) from the video
+    '''
+    frames = [convert_frame(crop_frame(frame, crop), sample) for frame in
+              iter_frames(video, start, end, step, fr, decimate, keyframes)]
 
     return np.array(frames)
 
@@ -30,10 +64,260 @@ def convert_frame(frame, sample=1.0):
     '''
     Convert frame to grayscale and resize
     '''
-    return cv2.cvtColor(cv2.resize(frame, None, fx=sample,
-                                   fy=sample), cv2.COLOR_BGR2GRAY)
+    resized = cv2.resize(frame, None, fx=sample, fy=sample)
+    if resized.ndim == 2:
+        # already gray, e.g., from FFmpegReader
+        return resized
+    return cv2.cvtColor(resized, cv2.COLOR_BGR2GRAY)
+
+class FFmpegReader():
+    '''
+    Read gray frames of a video through a pipe from an ffmpeg process:
+    seeking, frame selection (one of every step), crop and resize all
+    run inside ffmpeg, with multi-threaded decoding. frames() yields
+    what iter_frames + convert_frame give for the same arguments, up to
+    the resampling of the resize (mean difference below one gray level)
+    '''
+    def __init__(self, video_path, sample=1.0, crop=None, n_thread=0):
+        metadata = load_metadata(video_path)
+        self.fps = metadata['fps']
+        width, height = metadata['width'], metadata['height']
+
+        self.video_path = video_path
+        self.crop = crop
+        self.n_thread = n_thread
+
+        # output size as cv2.resize(fx=sample, fy=sample)
+        if crop is not None:
+            width, height = crop[2], crop[3]
+        self.width = int(round(width * sample))
+        self.height = int(round(height * sample))
+
+    @staticmethod
+    def available():
+        return shutil.which('ffmpeg') is not None
+
+    def frames(self, start, end, step=1, fr=120):
+        '''
+        Frames start_index + k * step - 1 (k >= 1) until end (sec), the
+        frames iter_frames keeps
+        '''
+        start_index = int(start * fr)
+        n_frame = int((end - start) * fr) // step
+        if n_frame <= 0:
+            return
+
+        # drop frames first; gray through bgr24 is the conversion OpenCV
+        # does, area resampling is the closest to cv2.resize on average
+        filters = ['select=eq(mod(n+1\\,%d)\\,0)' % step]
+        if self.crop is not None:
+            filters.append('crop=%d:%d:%d:%d' % (self.crop[2], self.crop[3],
+                                                 self.crop[0], self.crop[1]))
+        filters.append('format=bgr24,format=gray')
+        filters.append('scale=%d:%d:flags=area' % (self.width, self.height))
+
+        # seek half a frame early so rounding never drops the first frame
+        seek = max(start_index - 0.5, 0) / self.fps
+        cmd = ['ffmpeg', '-v', 'error', '-nostdin', '-threads', str(self.n_thread),
+               '-ss', '%.6f' % seek, '-i', self.video_path, '-an',
+               '-vf', ','.join(filters), '-vsync', '0', '-frames:v', str(n_frame),
+               '-f', 'rawvideo', '-pix_fmt', 'gray', 'pipe:1']
+
+        frame_size = self.width * self.height
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                   bufsize=frame_size * 8)
+        try:
+            for _ in range(n_frame):
+                buffer = process.stdout.read(frame_size)
+                if len(buffer) < frame_size:
+                    break
+                yield np.frombuffer(buffer, np.uint8).reshape(self.height,
+                                                              self.width)
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+def proxy_path(video_path, dsp=0.25):
+    '''
+    Path of the calibration proxy of the video at scale dsp, next to the
+    video itself (symlinks are resolved)
+    '''
+    real_path = os.path.realpath(video_path)
+    return '%s_proxy_%g.mkv' % (os.path.splitext(real_path)[0], dsp)
+
+def has_proxy(video_path, dsp=0.25):
+    '''
+    Whether the video has a proxy at scale dsp no older than itself
+    '''
+    path = proxy_path(video_path, dsp)
+    return os.path.exists(path) and \
+        os.path.getmtime(path) >= os.path.getmtime(video_path)
+
+def write_proxy(video_path, dsp=0.25, path=None, pbar=True):
+    '''
+    Write a grayscale copy of the video resized to dsp, encoded with
+    lossless FFV1: its frames are exactly convert_frame(frame, dsp).
+    Frames are piped to ffmpeg with a GOP of 1 (every frame a keyframe),
+    so any frame is reached without decoding the frames before it; when
+    ffmpeg is not installed, OpenCV writes it with its default GOP (12)
+    '''
+    path = path or proxy_path(video_path, dsp)
+    video = cv2.VideoCapture(video_path)
+    if not video.isOpened():
+        raise ValueError("Error: Cannot open video file.")
+
+    fps = video.get(cv2.CAP_PROP_FPS) or 120
+    n_frame = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    writer, process = None, None
+    with atomic_path(path) as tmp_path:
+        try:
+            for _ in tqdm(range(n_frame), disable=not pbar):
+                ret, frame = video.read()
+                if not ret:
+                    break
+
+                frame = convert_frame(frame, dsp)
+                if writer is None and process is None:
+                    height, width = frame.shape
+                    if shutil.which('ffmpeg') is not None:
+                        cmd = ['ffmpeg', '-v', 'error', '-y',
+                               '-f', 'rawvideo', '-pix_fmt', 'gray',
+                               '-s', f'{width}x{height}', '-r', f'{fps:g}',
+                               '-i', '-', '-c:v', 'ffv1', '-g', '1',
+                               '-pix_fmt', 'gray', '-f', 'matroska', tmp_path]
+                        process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+                    else:
+                        print('⚠️ Warning: ffmpeg not found, the proxy is not all-intra.')
+                        writer = cv2.VideoWriter(tmp_path,
+                                                 cv2.VideoWriter_fourcc(*'FFV1'),
+                                                 fps, (width, height),
+                                                 isColor=False)
+                        if not writer.isOpened():
+                            raise ValueError("Error: Cannot write proxy video.")
+
+                if process is not None:
+                    process.stdin.write(frame.tobytes())
+                else:
+                    writer.write(frame)
+        finally:
+            video.release()
+            if writer is not None:
+                writer.release()
+            if process is not None:
+                process.stdin.close()
+                process.wait()
+
+        if process is not None and process.returncode != 0:
+            raise ValueError("Error: Cannot write proxy video.")
+
+    return path
+
+def crop_frame(frame, crop=None):
+    '''
+    Crop rectangle (x, y, w, h) of the frame, in video pixels
+    '''
+    if crop is None:
+        return frame
+
+    x, y, w, h = crop
+    return frame[y:y + h, x:x + w]
+
+def scale_mask(mask, crop=None, sample=1.0):
+    '''
+    Bring a mask in video pixels to the (cropped, resized) frames used
+    for optical flow, as an 8-bit mask for OpenCV
+    '''
+    if mask is None:
+        return None
+
+    mask = np.uint8(crop_frame(mask, crop) > 0) * 255
+    return cv2.resize(mask, None, fx=sample, fy=sample,
+                      interpolation=cv2.INTER_NEAREST)
+
+def detect_roi(video, sample=0.25, n_sample=50, threshold=0.25):
+    '''
+    Auto-detect the region with useful motion from the temporal variance
+    of n_sample frames spread over the video: static rig borders and
+    occluders have (nearly) constant intensity
+
+    Returns (crop, mask) in video pixels, or (None, None) if no region
+    is found
+    '''
+    n_frame = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = []
+    for index in np.linspace(0, n_frame - 1, n_sample).astype(int):
+        video.set(cv2.CAP_PROP_POS_FRAMES, index)
+        ret, frame = video.read()
+        if ret:
+            size = frame.shape[:2]
+            frames.append(convert_frame(frame, sample))
+
+    if len(frames) < 2:
+        return None, None
+
+    std = np.std(np.array(frames, dtype=np.float32), axis=0)
+    mask = np.uint8(std > threshold * np.percentile(std, 95))
+
+    # remove isolated pixels and fill small holes
+    kernel = np.ones((3, 3), np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    if np.mean(mask) < 0.05:
+        return None, None
 
-def compute_flow(frames, polar=False, pbar=False):
+    # back to video pixels
+    mask = cv2.resize(mask, size[::-1], interpolation=cv2.INTER_NEAREST) > 0
+    crop = cv2.boundingRect(np.uint8(mask))
+
+    return crop, mask
+
+def farneback(prev_frame, frame, flow=None):
+    '''
+    Dense optical flow between two gray frames using Farneback method,
+    written into `flow` when a buffer of the right shape is given
+    '''
+    return cv2.calcOpticalFlowFarneback(prev_frame, frame, flow,
+                                        pyr_scale=0.5, levels=3,
+                                        winsize=15, iterations=3,
+                                        poly_n=5, poly_sigma=1.2, flags=0)
+
+class FrameGate():
+    '''
+    Flag (nearly) static frame pairs, whose mean absolute gray-level
+    difference is below threshold, so that motion estimation is skipped
+    and zero motion recorded for them; counts the pairs seen and skipped
+    '''
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.n_pair = 0
+        self.n_skip = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, prev_frame, frame, mask=None):
+        n_pixel = prev_frame.size if mask is None else cv2.countNonZero(mask)
+        diff = cv2.norm(prev_frame, frame, cv2.NORM_L1, mask) / max(n_pixel, 1)
+        static = diff < self.threshold
+
+        # called from the worker threads of pipeline_flow
+        with self.lock:
+            self.n_pair += 1
+            self.n_skip += int(static)
+        return static
+
+    def add(self, n_pair, n_skip):
+        with self.lock:
+            self.n_pair += n_pair
+            self.n_skip += n_skip
+
+    def report(self):
+        print('%d/%d frame pairs skipped as static (%.1f%%, gate %.2f)' % \
+              (self.n_skip, self.n_pair,
+               100 * self.n_skip / max(self.n_pair, 1), self.threshold))
+
+def compute_flow(frames, polar=False, pbar=False, gate=None):
     # initialization
     n_frame = frames.shape[0]
 
@@ -48,10 +332,10 @@ def compute_flow(frames, polar=False, pbar=False):
         frame = frames[i]
 
         # compute dense optical flow using Farneback method
-        flow = cv2.calcOpticalFlowFarneback(prev_frame, frame, None,
-                                            pyr_scale=0.5, levels=3,
-                                            winsize=15, iterations=3,
-                                            poly_n=5, poly_sigma=1.2, flags=0)
+        if gate is not None and gate(prev_frame, frame):
+            flow = np.zeros((*frame.shape, 2), dtype=np.float32)
+        else:
+            flow = farneback(prev_frame, frame)
         # roll forward frames
         prev_frame = frame
 
@@ -66,10 +350,18 @@ def compute_flow(frames, polar=False, pbar=False):
 
     return delta
 
-def average_flow(delta, flip_x=True, flip_y=True):
-    dx_bar = np.mean(delta[:, :, :, 0], axis=(1, 2))
-    dy_bar = np.mean(delta[:, :, :, 1], axis=(1, 2))
+def average_flow(delta, flip_x=True, flip_y=True, mask=None):
+    if mask is None:
+        dx_bar = np.mean(delta[:, :, :, 0], axis=(1, 2))
+        dy_bar = np.mean(delta[:, :, :, 1], axis=(1, 2))
+    else:
+        # average over the pixels in the mask only
+        dx_bar = np.mean(delta[:, mask > 0, 0], axis=1)
+        dy_bar = np.mean(delta[:, mask > 0, 1], axis=1)
+
+    return flip_flow(dx_bar, dy_bar, flip_x, flip_y)
 
+def flip_flow(dx_bar, dy_bar, flip_x=True, flip_y=True):
     if flip_x:
         dx_bar = -dx_bar
 
@@ -78,6 +370,223 @@ def average_flow(delta, flip_x=True, flip_y=True):
 
     return dx_bar, dy_bar
 
+class FarnebackMotion():
+    '''
+    Mean of the dense Farneback flow (reference estimator)
+    '''
+    def __init__(self, mask=None):
+        self.mask = mask
+        self.flow = None
+
+    def __call__(self, prev_frame, frame):
+        self.flow = farneback(prev_frame, frame, self.flow)
+        mean = cv2.mean(self.flow, mask=self.mask)
+        return mean[0], mean[1]
+
+class DISMotion():
+    '''
+    Mean of the dense DIS optical flow
+    '''
+    def __init__(self, mask=None, preset=cv2.DISOPTICAL_FLOW_PRESET_FAST):
+        self.mask = mask
+        self.dis = cv2.DISOpticalFlow_create(preset)
+
+    def __call__(self, prev_frame, frame):
+        mean = cv2.mean(self.dis.calc(prev_frame, frame, None), mask=self.mask)
+        return mean[0], mean[1]
+
+class PhaseMotion():
+    '''
+    Global translation from FFT phase correlation
+    '''
+    def __init__(self, mask=None):
+        self.mask = mask
+        self.window = None
+
+    def __call__(self, prev_frame, frame):
+        if self.window is None:
+            self.window = cv2.createHanningWindow(prev_frame.shape[::-1],
+                                                  cv2.CV_32F)
+            if self.mask is not None:
+                self.window *= np.float32(self.mask > 0)
+
+        (dx, dy), _ = cv2.phaseCorrelate(np.float32(prev_frame),
+                                         np.float32(frame), self.window)
+        return dx, dy
+
+class SparseMotion():
+    '''
+    Mean displacement of corner features tracked with pyramidal
+    Lucas-Kanade, re-detected when too few of them survive
+    '''
+    # tracked points carry over between pairs, pairs must run in order
+    sequential = True
+
+    def __init__(self, mask=None, n_point=200, min_point=50):
+        self.mask = mask
+        self.n_point = n_point
+        self.min_point = min_point
+        self.points = None
+
+    def __call__(self, prev_frame, frame):
+        if self.points is None or len(self.points) < self.min_point:
+            self.points = cv2.goodFeaturesToTrack(prev_frame, self.n_point,
+                                                  qualityLevel=0.01,
+                                                  minDistance=5,
+                                                  mask=self.mask)
+            if self.points is None:
+                return 0.0, 0.0
+
+        points, status, _ = cv2.calcOpticalFlowPyrLK(prev_frame, frame,
+                                                     self.points, None)
+        status = status[:, 0] == 1
+        if not np.any(status):
+            self.points = None
+            return 0.0, 0.0
+
+        dx, dy = np.mean((points - self.points)[status, 0], axis=0)
+
+        # keep tracking the surviving points in the next frame
+        self.points = points[status]
+        return float(dx), float(dy)
+
+# global motion estimators for stream_flow / VideoData(method=...)
+MOTION_ESTIMATORS = {
+    'farneback': FarnebackMotion,
+    'dis': DISMotion,
+    'phase': PhaseMotion,
+    'sparse': SparseMotion,
+}
+
+def stream_flow(frames, sample=1.0, flip_x=True, flip_y=True, pbar=False,
+                method='farneback', crop=None, mask=None, gate=None):
+    '''
+    Streaming version of compute_flow + average_flow: each frame pair is
+    reduced to its mean motion (dx, dy) as soon as it is computed, and
+    only the previous frame is kept, so memory does not grow with the
+    window length
+
+    frames: iterable of raw BGR frames (e.g., from iter_frames)
+    method: global motion estimator, a key of MOTION_ESTIMATORS
+    crop: (x, y, w, h) region of the frames, in video pixels
+    mask: boolean mask of the pixels to use, in video pixels
+    gate: FrameGate, static pairs get zero motion without estimation
+    '''
+    mask = scale_mask(mask, crop, sample)
+    estimator = MOTION_ESTIMATORS[method](mask)
+    dx_bar, dy_bar = [], []
+
+    # buffers reused across frames
+    resized = prev_frame = frame = None
+    for raw in tqdm(frames, disable=not pbar):
+        # same operations as convert_frame, written into the buffers
+        if raw.ndim == 2:
+            frame = cv2.resize(crop_frame(raw, crop), None, dst=frame,
+                               fx=sample, fy=sample)
+        else:
+            resized = cv2.resize(crop_frame(raw, crop), None, dst=resized,
+                                 fx=sample, fy=sample)
+            frame = cv2.cvtColor(resized, cv2.COLOR_BGR2GRAY, dst=frame)
+
+        if prev_frame is not None:
+            if gate is not None and gate(prev_frame, frame, mask):
+                dx, dy = 0.0, 0.0
+            else:
+                dx, dy = estimator(prev_frame, frame)
+            dx_bar.append(dx)
+            dy_bar.append(dy)
+
+        # roll forward frames (swap buffers)
+        prev_frame, frame = frame, prev_frame
+
+    return flip_flow(np.array(dx_bar), np.array(dy_bar), flip_x, flip_y)
+
+def pipeline_flow(frames, sample=1.0, flip_x=True, flip_y=True, pbar=False,
+                  method='farneback', n_thread=4, queue_size=64,
+                  crop=None, mask=None, gate=None):
+    '''
+    Same output as stream_flow, with decoding and motion estimation
+    overlapped: a producer thread decodes and converts frames into a
+    bounded queue, and n_thread workers estimate the motion of frame
+    pairs concurrently (OpenCV releases the GIL). Results are collected
+    in frame order, and at most queue_size frames are held at a time
+    '''
+    estimator_class = MOTION_ESTIMATORS[method]
+    if getattr(estimator_class, 'sequential', False):
+        n_thread = 1
+
+    # one estimator per worker thread, they keep internal buffers
+    local = threading.local()
+    mask = scale_mask(mask, crop, sample)
+    def estimate(prev_frame, frame):
+        if gate is not None and gate(prev_frame, frame, mask):
+            return 0.0, 0.0
+        if not hasattr(local, 'estimator'):
+            local.estimator = estimator_class(mask)
+        return local.estimator(prev_frame, frame)
+
+    # producer: decode and convert frames
+    frame_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    error = []
+    def put(frame):
+        # give up when the consumer has stopped
+        while not stop.is_set():
+            try:
+                frame_queue.put(frame, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for raw in frames:
+                if not put(convert_frame(crop_frame(raw, crop), sample)):
+                    return
+        except Exception as e:
+            error.append(e)
+        put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    dx_bar, dy_bar = [], []
+    pending = deque()
+    progress = tqdm(disable=not pbar)
+    try:
+        with ThreadPoolExecutor(max_workers=n_thread) as executor:
+            prev_frame = frame_queue.get()
+            while prev_frame is not None:
+                frame = frame_queue.get()
+                if frame is None:
+                    break
+
+                pending.append(executor.submit(estimate, prev_frame, frame))
+                prev_frame = frame
+
+                # bound the number of pairs in flight
+                while len(pending) >= queue_size:
+                    dx, dy = pending.popleft().result()
+                    dx_bar.append(dx)
+                    dy_bar.append(dy)
+                    progress.update()
+
+            while pending:
+                dx, dy = pending.popleft().result()
+                dx_bar.append(dx)
+                dy_bar.append(dy)
+                progress.update()
+    finally:
+        stop.set()
+        progress.close()
+
+    producer.join()
+    if error:
+        raise error[0]
+
+    return flip_flow(np.array(dx_bar), np.array(dy_bar), flip_x, flip_y)
+
 def flow_rgb(magnitude, angle):
     '''
     Convert optical flow to RGB for visualization
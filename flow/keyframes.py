@@ -0,0 +1,144 @@
+'''
+Keyframe index of a video, kept as a sidecar <name>_keyframes.npz next
+to it: frame numbers (and times) of the keyframes plus the frame count,
+so readers seek straight to the keyframe before a target frame and only
+decode forward from there
+'''
+import os
+import shutil
+import subprocess
+import numpy as np
+import cv2
+
+from .atomic import atomic_path
+from .metadata import load_metadata
+
+# indexes already read or scanned by this process, by video path
+_memo = {}
+
+def keyframe_path(video_path, cache_dir=None):
+    path = os.path.splitext(os.path.realpath(video_path))[0] + '_keyframes.npz'
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, os.path.basename(path))
+    return path
+
+def scan_keyframes(video_path):
+    '''
+    Keyframe numbers and times (sec) of the video, and its frame count.
+    Uses ffprobe when available (keyframes only are decoded), otherwise
+    reads the demuxed packets through OpenCV without decoding them
+    '''
+    if shutil.which('ffprobe') is not None:
+        try:
+            return probe_keyframes(video_path)
+        except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+            print(f'⚠️ Warning: ffprobe failed on {video_path}, using OpenCV: {e}')
+
+    video = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
+    if not video.isOpened():
+        raise ValueError("Error: Cannot open video file.")
+
+    fps = video.get(cv2.CAP_PROP_FPS)
+    video.set(cv2.CAP_PROP_FORMAT, -1)
+
+    # packets are counted in decode order, which matches the display
+    # order of keyframes unless B-frames are reordered across them
+    frame, n_frame = [], 0
+    while video.grab():
+        if video.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+            frame.append(n_frame)
+        n_frame += 1
+    video.release()
+
+    frame = np.array(frame, dtype=np.int64)
+    return frame, frame / fps, n_frame
+
+def probe_keyframes(video_path):
+    # one pass over the keyframes, the frame count and rate come from
+    # the shared metadata cache
+    metadata = load_metadata(video_path)
+    fps, n_frame = metadata['fps'], metadata['n_frame']
+    if fps <= 0:
+        raise ValueError("Error: Unknown frame rate.")
+
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-skip_frame', 'nokey', '-show_entries', 'frame=pts_time',
+           '-of', 'csv=p=0', video_path]
+    output = subprocess.run(cmd, capture_output=True, check=True,
+                            text=True).stdout
+    time = np.array([float(line.strip(',')) for line in output.split()
+                     if line.strip(',') not in ('', 'N/A')])
+
+    frame = np.round(time * fps).astype(np.int64)
+    return frame, time, n_frame
+
+def load_keyframes(video_path, build=True, cache_dir=None):
+    '''
+    Keyframe index of the video, see scan_keyframes. The sidecar (next to
+    the video, or in cache_dir) is rebuilt when the video changed (size
+    or mtime) if build=True, otherwise None is returned for a missing or
+    stale index. Indexes are also kept in memory, so a sidecar that
+    cannot be written does not make every call scan the video again
+    '''
+    path = keyframe_path(video_path, cache_dir)
+    stat = os.stat(video_path)
+
+    def is_valid(index):
+        return (index is not None and index['size'] == stat.st_size and
+                index['mtime_ns'] == stat.st_mtime_ns)
+
+    real_path = os.path.realpath(video_path)
+    if is_valid(_memo.get(real_path)):
+        return _memo[real_path]
+
+    if os.path.exists(path):
+        index = dict(np.load(path))
+        if is_valid(index):
+            _memo[real_path] = index
+            return index
+
+    if not build:
+        return None
+
+    frame, time, n_frame = scan_keyframes(video_path)
+    index = dict(frame=frame, time=time, n_frame=n_frame,
+                 size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    _memo[real_path] = index
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        with atomic_path(path) as tmp_path, open(tmp_path, 'wb') as f:
+            np.savez(f, **index)
+    except OSError as e:
+        print(f'⚠️ Warning: cannot write keyframe index {path}: {e}')
+
+    return index
+
+def seek_frame(video, index, keyframes=None):
+    '''
+    Position the video so that the next grab returns frame `index`.
+    With a keyframe array, seek to the last keyframe at or before index
+    (or stay, if the current position is already past it) and grab
+    forward, instead of letting the backend search for a keyframe
+    '''
+    if keyframes is None or len(keyframes) == 0:
+        # reads that continue from the current position need no seek
+        if int(video.get(cv2.CAP_PROP_POS_FRAMES)) != index:
+            video.set(cv2.CAP_PROP_POS_FRAMES, index)
+        return
+
+    key = keyframes[max(np.searchsorted(keyframes, index, side='right') - 1, 0)]
+    position = int(video.get(cv2.CAP_PROP_POS_FRAMES))
+    if not key <= position <= index:
+        video.set(cv2.CAP_PROP_POS_FRAMES, int(key))
+        position = int(video.get(cv2.CAP_PROP_POS_FRAMES))
+
+    if position > index:
+        # the backend landed past the target, let it seek by itself
+        video.set(cv2.CAP_PROP_POS_FRAMES, index)
+        return
+
+    for _ in range(index - position):
+        if not video.grab():
+            break
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Write calibration proxies of HS videos.
+
+Usage:
+    python flow/make_proxy.py <video_path> [<video_path> ...] [--dsp SCALE]
+
+Each proxy is a grayscale, dsp-scaled, all-intra FFV1 copy of the video
+written next to it (next to the linked file for a symlink) as
+<name>_proxy_<dsp>.mkv (all-intra needs ffmpeg on the PATH, see
+write_proxy). VideoData reads the proxy instead of the video when it
+exists, with identical motion results. run_calibration submits this as a
+cluster job ahead of the calibration job when the proxy is missing.
+"""
+import argparse
+import sys
+import os
+
+# Add project root to path so we can import flow modules
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_ROOT)
+
+from flow.compute import proxy_path, has_proxy, write_proxy
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('video_path', type=str, nargs='+')
+    parser.add_argument('--dsp', type=float, default=0.25)
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args()
+
+    for video_path in args.video_path:
+        # the proxy goes next to the video, not next to a link to it
+        video_path = os.path.realpath(video_path)
+        path = proxy_path(video_path, args.dsp)
+        if not args.force and has_proxy(video_path, args.dsp):
+            print(f'Proxy {path} is up to date')
+            continue
+
+        print(f'Writing proxy of {video_path}')
+        write_proxy(video_path, args.dsp, path)
+        print(f'Saved proxy to {path}')
+
+
+if __name__ == '__main__':
+    main()
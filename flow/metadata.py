@@ -0,0 +1,125 @@
+'''
+Video metadata (frame count, fps, frame size, duration, codec), probed
+once through OpenCV and kept in a video_metadata.json shared by all the
+videos of a directory, keyed by the resolved video path; an entry is
+valid while the size and mtime of its video do not change
+'''
+import os
+import json
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+from .atomic import atomic_path
+
+METADATA_NAME = 'video_metadata.json'
+
+# entries already read or probed by this process
+_memo = {}
+
+def metadata_path(video_path):
+    return os.path.join(os.path.dirname(os.path.realpath(video_path)),
+                        METADATA_NAME)
+
+def probe_metadata(video_path):
+    video = cv2.VideoCapture(video_path)
+    if not video.isOpened():
+        raise ValueError("Error: Cannot open video file.")
+
+    fourcc = int(video.get(cv2.CAP_PROP_FOURCC))
+    n_frame = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = video.get(cv2.CAP_PROP_FPS)
+    metadata = dict(n_frame=n_frame, fps=fps,
+                    width=int(video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                    height=int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                    duration=n_frame / fps if fps > 0 else 0.0,
+                    codec=''.join(chr((fourcc >> 8 * i) & 0xFF)
+                                  for i in range(4)).strip('\x00 '))
+    video.release()
+    return metadata
+
+def read_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_cache(path, entries):
+    # merge with the entries other jobs may have written meanwhile
+    cache = read_cache(path)
+    cache.update(entries)
+
+    try:
+        with atomic_path(path) as tmp_path, open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+    except OSError as e:
+        print(f'⚠️ Warning: cannot write video metadata {path}: {e}')
+
+def is_valid(entry, stat):
+    return (entry is not None and entry['size'] == stat.st_size and
+            entry['mtime_ns'] == stat.st_mtime_ns)
+
+def load_metadata(video_path, cache=True):
+    '''
+    Dict of n_frame, fps, width, height, duration (sec) and codec (fourcc)
+    of the video. Read from the shared cache, or probed (and added to the
+    cache with cache=True) if missing or stale
+    '''
+    real_path = os.path.realpath(video_path)
+    stat = os.stat(real_path)
+
+    entry = _memo.get(real_path)
+    if cache and not is_valid(entry, stat):
+        entry = read_cache(metadata_path(real_path)).get(real_path)
+
+    if not is_valid(entry, stat):
+        entry = dict(probe_metadata(real_path), size=stat.st_size,
+                     mtime_ns=stat.st_mtime_ns)
+        if cache:
+            write_cache(metadata_path(real_path), {real_path: entry})
+
+    _memo[real_path] = entry
+    return dict(entry)
+
+def scan_metadata(video_paths, n_thread=8, force=False):
+    '''
+    Bulk pre-scan: probe the videos missing from (or stale in) the cache,
+    n_thread at a time, with one cache write per directory. Returns a
+    dict of video path -> metadata of the videos that could be opened
+    '''
+    real_paths = {path: os.path.realpath(path) for path in video_paths}
+    stats = {real_path: os.stat(real_path) for real_path in real_paths.values()}
+
+    by_dir = {}
+    for real_path in stats:
+        by_dir.setdefault(metadata_path(real_path), []).append(real_path)
+
+    for path, dir_paths in by_dir.items():
+        cache = read_cache(path)
+        todo = [real_path for real_path in dir_paths
+                if force or not is_valid(cache.get(real_path), stats[real_path])]
+
+        with ThreadPoolExecutor(max_workers=max(n_thread, 1)) as executor:
+            probed = executor.map(_probe_metadata, todo)
+            entries = {real_path: dict(metadata, size=stats[real_path].st_size,
+                                       mtime_ns=stats[real_path].st_mtime_ns)
+                       for real_path, metadata in zip(todo, probed)
+                       if metadata is not None}
+        if entries:
+            write_cache(path, entries)
+
+        cache.update(entries)
+        for real_path in dir_paths:
+            if is_valid(cache.get(real_path), stats[real_path]):
+                _memo[real_path] = cache[real_path]
+
+    # videos that cannot be opened are left out
+    return {path: dict(_memo[real_path]) for path, real_path in real_paths.items()
+            if real_path in _memo}
+
+def _probe_metadata(video_path):
+    try:
+        return probe_metadata(video_path)
+    except ValueError:
+        print(f'⚠️ Warning: cannot open {video_path}, skipped.')
+        return None
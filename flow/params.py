@@ -0,0 +1,75 @@
+'''
+Columns of the ccf_all_params CSVs, parsed once and kept in a columnar
+sidecar next to the CSV: a (n_column, n_row) float64 .npy named after
+the CSV and the columns, followed in the same file by the identity
+(size, mtime) of the CSV it was parsed from. Later loads memory-map it
+instead of parsing the CSV again; a changed CSV overwrites its sidecar
+'''
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+from .atomic import atomic_path
+
+# columns used by ZaberData and generate_index
+PARAM_COLUMNS = ('relative_time', 'zaber_x', 'zaber_y')
+
+def params_path(csv_path, columns=PARAM_COLUMNS, cache_dir=None):
+    real_path = os.path.realpath(csv_path)
+    key = hashlib.sha1(','.join(columns).encode()).hexdigest()[:16]
+
+    cache_dir = cache_dir or os.path.dirname(real_path)
+    name = os.path.basename(real_path)[:-4]
+    return os.path.join(cache_dir, f'{name}_cols_{key}.npy')
+
+def csv_identity(csv_path):
+    stat = os.stat(os.path.realpath(csv_path))
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def read_table(path):
+    '''
+    Memory-mapped table of the sidecar, and the CSV identity saved after it
+    '''
+    table = np.load(path, mmap_mode='r')
+    with open(path, 'rb') as f:
+        f.seek(table.offset + table.nbytes)
+        identity = np.load(f)
+    return table, identity
+
+def load_params(csv_path, columns=PARAM_COLUMNS, cache=True, cache_dir=None):
+    '''
+    Dict of column name -> float64 array. With cache=True the arrays are
+    views of the memory-mapped sidecar, written on the first load and
+    rewritten in place when the CSV changed (size or mtime)
+    '''
+    columns = tuple(columns)
+    path = params_path(csv_path, columns, cache_dir)
+    identity = csv_identity(csv_path)
+    if cache and os.path.exists(path):
+        try:
+            table, cached = read_table(path)
+        except (OSError, ValueError, EOFError):
+            # a sidecar of an older layout, written again below
+            table, cached = None, None
+        if cached is not None and np.array_equal(cached, identity):
+            # plain ndarray views, still backed by the memory map
+            table = np.asarray(table)
+            return {column: table[i] for i, column in enumerate(columns)}
+
+    # only the needed columns, same parser (and values) as a full read
+    data_frame = pd.read_csv(csv_path, usecols=list(columns), low_memory=False)
+    table = np.stack([data_frame[column].to_numpy(dtype=float)
+                      for column in columns])
+
+    if cache:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with atomic_path(path) as tmp_path, open(tmp_path, 'wb') as f:
+                np.save(f, table)
+                np.save(f, identity)
+        except OSError as e:
+            print(f'⚠️ Warning: cannot write column cache {path}: {e}')
+
+    return {column: table[i] for i, column in enumerate(columns)}
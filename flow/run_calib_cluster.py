@@ -3,8 +3,42 @@
 
 Usage:
     python flow/run_calib_cluster.py <zaber_path> <video_path> <hs_name> \
-        <init_lag> <init_window> <t_max> <n_point> <window>
+        <init_lag> <init_window> <t_max> <n_point> <window> [mode] \
+        [--max-lag SEC] [--method NAME] [--n-worker N] [--n-thread N] \
+        [--step N] [--subsample] [--placement active] [--adaptive] \
+        [--crop X Y W H] [--roi auto|MASK_IMAGE] [--backend ffmpeg] \
+        [--gate LEVEL] [--frame-log CSV] [--n-verify N] [--restart]
+
+mode: 'anchor' (default) computes flow for each anchor window;
+      'trace' decodes the video once and scores all anchors in one batch
+--max-lag: search anchor lags only within init_lag +/- max_lag (sec)
+--method: global motion estimator (farneback, dis, phase, sparse)
+--n-worker: anchor worker processes (default: slots allocated by bsub -n)
+--n-thread: threads pipelining decoding and flow within each window
+--step: temporal sampling of the video frames (default 4)
+--subsample: sub-sample (parabolic) lag refinement, for coarser steps
+--placement: 'uniform' anchors (default) or 'active' to skip windows
+             where the zaber stage is idle (--min-activity)
+--adaptive: start from --n-init anchors and refine where the lag model
+            is off by more than --tol (sec); n_point is the maximum
+--crop: region of the video (pixels) used for optical flow
+--roi: mask of the pixels averaged into the motion, an image or 'auto'
+       to detect the moving region (and crop to it unless --crop is set)
+--backend: 'opencv' (default) or 'ffmpeg' to decode, select and resize
+           frames in an ffmpeg process (falls back to OpenCV)
+--gate: skip optical flow on frame pairs whose mean absolute difference
+        is below LEVEL gray levels (static pairs get zero motion)
+--frame-log: hs_cam_frames CSV of the session; anchor lags are read from
+             it and verified with optical flow at --n-verify anchors,
+             falling back to the anchor sweep if verification fails
+             (without --max-lag if the log does not match the video)
+--restart: ignore the partial results of a previous run of this job
+
+Anchor results are appended to <hs_name>_calib.partial.csv in HS_BASE as
+they finish; a rerun of a killed job only computes the missing anchors.
+The partial file is removed once the final _calib.csv is written.
 """
+import argparse
 import sys
 import os
 import numpy as np
@@ -18,7 +52,10 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 sys.path.insert(0, PROJECT_ROOT)
 
-from flow.calibrate import compute_lag, exclude_outliers
+from flow.calibrate import CalibrationSession, calib_anchor, exclude_outliers, n_worker
+from flow.calibrate import place_anchors, calib_adaptive
+from flow.calibrate import FrameLog, calib_video_log, calib_video_init
+from flow.compute import MOTION_ESTIMATORS
 from flow.constants import HS_BASE
 
 # Use absolute TMP_PATH since cluster working directory may differ
@@ -26,39 +63,131 @@ TMP_PATH = os.path.join(PROJECT_ROOT, '.tmp')
 
 
 def main():
-    if len(sys.argv) != 9:
-        print(f"Usage: {sys.argv[0]} <zaber_path> <video_path> <hs_name> "
-              "<init_lag> <init_window> <t_max> <n_point> <window>")
-        sys.exit(1)
-
-    zaber_path = sys.argv[1]
-    video_path = sys.argv[2]
-    hs_name = sys.argv[3]
-    init_lag = float(sys.argv[4])
-    init_window = float(sys.argv[5])
-    t_max = float(sys.argv[6])
-    n_point = int(sys.argv[7])
-    window = int(sys.argv[8])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('zaber_path', type=str)
+    parser.add_argument('video_path', type=str)
+    parser.add_argument('hs_name', type=str)
+    parser.add_argument('init_lag', type=float)
+    parser.add_argument('init_window', type=float)
+    parser.add_argument('t_max', type=float)
+    parser.add_argument('n_point', type=int)
+    parser.add_argument('window', type=int)
+    parser.add_argument('mode', type=str, nargs='?', default='anchor',
+                        choices=['anchor', 'trace'])
+    parser.add_argument('--max-lag', type=float, default=None)
+    parser.add_argument('--method', type=str, default='farneback',
+                        choices=list(MOTION_ESTIMATORS))
+    parser.add_argument('--n-worker', type=int, default=n_worker())
+    parser.add_argument('--n-thread', type=int, default=1)
+    parser.add_argument('--step', type=int, default=4)
+    parser.add_argument('--subsample', action='store_true')
+    parser.add_argument('--placement', type=str, default='uniform',
+                        choices=['uniform', 'active'])
+    parser.add_argument('--min-activity', type=float, default=0.1)
+    parser.add_argument('--adaptive', action='store_true')
+    parser.add_argument('--n-init', type=int, default=8)
+    parser.add_argument('--tol', type=float, default=None)
+    parser.add_argument('--crop', type=int, nargs=4, default=None,
+                        metavar=('X', 'Y', 'W', 'H'))
+    parser.add_argument('--roi', type=str, default=None)
+    parser.add_argument('--backend', type=str, default='opencv',
+                        choices=['opencv', 'ffmpeg'])
+    parser.add_argument('--gate', type=float, default=None)
+    parser.add_argument('--frame-log', type=str, default=None)
+    parser.add_argument('--n-verify', type=int, default=5)
+    parser.add_argument('--restart', action='store_true')
+    args = parser.parse_args()
+
+    zaber_path = args.zaber_path
+    video_path = args.video_path
+    hs_name = args.hs_name
+    init_lag = args.init_lag
+    init_window = args.init_window
+    t_max = args.t_max
+    n_point = args.n_point
+    window = args.window
+    mode = args.mode
+    max_lag = args.max_lag
+    method = args.method
+    workers = args.n_worker
+    threads = args.n_thread
+    step = args.step
+    subsample = args.subsample
+    placement = args.placement
 
     print(f'Running anchor calibration for {hs_name}')
     print(f'  init_lag={init_lag:.3f}, init_window={init_window}, '
-          f't_max={t_max:.1f}, n_point={n_point}, window={window}')
-
-    # run calibration along anchor points t0
-    from tqdm import tqdm
-
-    t0 = np.linspace(init_window, t_max, n_point)
-
-    all_lag = np.zeros_like(t0, dtype=float)
-    video_index = np.zeros_like(t0, dtype=int)
-    zaber_index = np.zeros_like(t0, dtype=int)
-    corr_val = np.zeros_like(t0, dtype=float)
-    calibration = [all_lag, video_index, zaber_index, corr_val]
-
-    for i in tqdm(range(len(t0)), miniters=5):
-        calib_result = compute_lag(zaber_path, video_path, t0[i], window, init_lag)
-        for j in range(len(calibration)):
-            calibration[j][i] = calib_result[j]
+          f't_max={t_max:.1f}, n_point={n_point}, window={window}, '
+          f'mode={mode}, max_lag={max_lag}, method={method}, '
+          f'n_worker={workers}, n_thread={threads}, step={step}, '
+          f'subsample={subsample}, placement={placement}, '
+          f'adaptive={args.adaptive}, crop={args.crop}, roi={args.roi}, '
+          f'backend={args.backend}, gate={args.gate}, '
+          f'frame_log={args.frame_log}')
+
+    # partial results of the anchors, to resume a killed job
+    checkpoint = os.path.join(HS_BASE, hs_name[:-4] + '_calib.partial.csv')
+    if args.restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    with CalibrationSession(zaber_path, video_path, step=step, method=method,
+                            n_thread=threads, subsample=subsample,
+                            crop=args.crop, mask=args.roi,
+                            backend=args.backend, gate=args.gate) as session:
+        if session.video.crop is not None:
+            print('  flow region: x=%d, y=%d, w=%d, h=%d' % session.video.crop)
+
+        # hardware frame log: lags from the log, checked at a few anchors
+        status = None
+        if args.frame_log is not None:
+            try:
+                t0, calibration, status = calib_video_log(session,
+                                                          FrameLog(args.frame_log),
+                                                          window, n_point,
+                                                          args.n_verify)
+            except Exception as e:
+                print(f'⚠️ Warning: cannot use frame log {args.frame_log}: {e}')
+                status = 'failed'
+
+            if status == 'failed':
+                # the log does not match the video: its initial lag was never
+                # checked, search it from the video as without a log, and
+                # without the log's band
+                max_lag = None
+                result = calib_video_init(zaber_path, video_path, window,
+                                          session)
+                if result is None:
+                    print('Calibration failed - initial estimate returned None')
+                    return
+                init_lag, init_window, t_max = result
+
+        if status != 'verified':
+            # run calibration along anchor points t0
+            if args.adaptive:
+                t0, calibration = calib_adaptive(session, init_window, t_max,
+                                                 window, init_lag, args.n_init,
+                                                 n_point, args.tol,
+                                                 max_lag=max_lag,
+                                                 n_worker=workers,
+                                                 trace=mode == 'trace',
+                                                 checkpoint=checkpoint)
+            else:
+                if placement == 'active':
+                    t0 = place_anchors(session.zaber, init_window, t_max, n_point,
+                                       window, args.min_activity)
+                else:
+                    t0 = np.linspace(init_window, t_max, n_point)
+
+                if mode == 'trace':
+                    calibration = session.compute_lags(t0, window, init_lag,
+                                                       max_lag)
+                else:
+                    calibration = calib_anchor(session, t0, window, init_lag,
+                                               max_lag=max_lag, n_worker=workers,
+                                               checkpoint=checkpoint)
+
+        if session.video.gate is not None:
+            session.video.gate.report()
 
     # exclude outliers
     t0, calibration = exclude_outliers(t0, calibration)
@@ -88,6 +217,9 @@ def main():
     df.to_csv(output_path, index=False)
     print(f'Saved calibration data to {output_path}')
 
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
 
 if __name__ == '__main__':
     main()
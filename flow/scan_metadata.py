@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""Pre-scan the metadata of videos into the shared metadata cache.
+
+Usage:
+    python flow/scan_metadata.py <video_path> [<video_path> ...] [--n-thread N]
+
+The frame count, fps, frame size, duration and codec of each video are
+stored in video_metadata.json in its directory (see flow/metadata.py),
+where calibration and generate_index read them instead of opening the
+video. Videos already in the cache and unchanged are not opened again.
+"""
+import argparse
+import sys
+import os
+
+# Add project root to path so we can import flow modules
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_ROOT)
+
+from flow.metadata import scan_metadata
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('video_path', type=str, nargs='+')
+    parser.add_argument('--n-thread', type=int, default=8)
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args()
+
+    metadata = scan_metadata(args.video_path, args.n_thread, args.force)
+    for video_path in args.video_path:
+        entry = metadata.get(video_path)
+        if entry is None:
+            continue
+        print(f"{video_path}: {entry['n_frame']} frames, {entry['fps']:g} fps, "
+              f"{entry['width']}x{entry['height']}, {entry['duration']:.1f} s, "
+              f"{entry['codec']}")
+
+
+if __name__ == '__main__':
+    main()
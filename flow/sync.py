@@ -0,0 +1,259 @@
+'''
+Compact zaber -> HS video sync model of a session: the calibration
+anchors (zaber index, video index) plus the zaber timeline
+(relative_time), saved as <prefix>_sync.npz. It answers frame queries
+directly, without the dense one-row-per-sample table, which can still
+be written as a memory-mappable int32 .npy (or exported as CSV)
+'''
+import numpy as np
+import pandas as pd
+
+from .atomic import atomic_path
+from .metadata import load_metadata
+from .params import load_params
+
+HS_FRAME_RATE = 120
+
+def nearest_anchor(zaber_axis, idx):
+    '''
+    Position in zaber_axis of the anchor closest to each zaber index in
+    idx, the first one (in zaber_axis order) on ties, as np.argmin would
+    give. Uses a binary search on the sorted anchors
+    '''
+    if zaber_axis.size == 0:
+        raise ValueError("attempt to get argmin of an empty sequence")
+
+    # stable sort: equal anchors keep their order, the first of a run
+    # has the smallest position
+    order = np.argsort(zaber_axis, kind='stable')
+    sorted_axis = zaber_axis[order]
+
+    right = np.searchsorted(sorted_axis, idx)
+    left = np.maximum(right - 1, 0)
+    right = np.minimum(right, sorted_axis.size - 1)
+
+    # first anchor of each candidate value
+    left = order[np.searchsorted(sorted_axis, sorted_axis[left])]
+    right = order[np.searchsorted(sorted_axis, sorted_axis[right])]
+
+    left_dist = np.abs(zaber_axis[left] - idx)
+    right_dist = np.abs(zaber_axis[right] - idx)
+    return np.where((left_dist < right_dist) |
+                    ((left_dist == right_dist) & (left < right)), left, right)
+
+def sync_path(prefix):
+    return prefix + '_sync.npz'
+
+def index_path(prefix):
+    return prefix + '_hs_index.npy'
+
+def load_index(path):
+    '''
+    Dense HS frame index (-1 outside the video) of every zaber sample,
+    memory-mapped
+    '''
+    return np.load(path, mmap_mode='r')
+
+class SyncModel():
+    '''
+    Nearest-anchor mapping of zaber samples to HS frames: sample i takes
+    the closest anchor (z, v) and lands on frame
+    v + (t[i] - t[z]) * fr, truncated, or -1 outside [0, hs_length).
+    Range and inverse queries assume relative_time is increasing
+    '''
+    def __init__(self, zaber_axis, video_axis, relative_time, hs_length,
+                 fr=HS_FRAME_RATE):
+        self.zaber_axis = np.asarray(zaber_axis)
+        self.video_axis = np.asarray(video_axis)
+        self.t = np.asarray(relative_time, dtype=float)
+        self.hs_length = int(hs_length)
+        self.fr = fr
+
+        if self.zaber_axis.size != self.video_axis.size:
+            raise ValueError("Error: zaber and video anchors differ in length.")
+
+    @classmethod
+    def from_files(cls, csv_path, calib_path, hs_video_path, fr=HS_FRAME_RATE):
+        '''
+        Model from the behavioral CSV, the calibration CSV and the HS video
+        (frame count from the shared video metadata cache)
+        '''
+        time_array = load_params(csv_path)['relative_time']
+
+        calib_array = pd.read_csv(calib_path)
+        calib_axis = calib_array[['video_index', 'zaber_index']].to_numpy().T
+
+        hs_length = int(load_metadata(hs_video_path)['n_frame'])
+        return cls(calib_axis[1], calib_axis[0], time_array, hs_length, fr)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['zaber_index'], data['video_index'],
+                       data['relative_time'], data['hs_length'],
+                       float(data['fr']))
+
+    def save(self, path, **meta):
+        '''
+        Save the model, with extra meta arrays (e.g. input hashes) that
+        load ignores
+        '''
+        with atomic_path(path) as tmp_path, open(tmp_path, 'wb') as f:
+            np.savez(f, zaber_index=self.zaber_axis, video_index=self.video_axis,
+                     relative_time=self.t, hs_length=self.hs_length, fr=self.fr,
+                     **meta)
+
+    def __len__(self):
+        return self.t.size
+
+    def raw_frame(self, idx, anchor=None):
+        '''
+        Untruncated HS frame position of zaber indices idx, from the
+        nearest anchors (or the given anchor positions)
+        '''
+        idx = np.asarray(idx)
+        if anchor is None:
+            anchor = nearest_anchor(self.zaber_axis, idx)
+        zaber_frame = self.zaber_axis[anchor].astype(int)
+        delta = (self.t[idx] - self.t[zaber_frame]) * self.fr
+        return self.video_axis[anchor] + delta
+
+    def hs_frame(self, idx):
+        '''
+        HS frame of zaber indices idx, -1 outside the video
+        '''
+        frame = self.raw_frame(idx)
+        if not np.all(np.isfinite(frame)):
+            raise ValueError("cannot convert float NaN to integer")
+        frame = np.trunc(frame).astype(int)
+        return np.where((frame < 0) | (frame >= self.hs_length), -1, frame)
+
+    def cells(self):
+        '''
+        Anchor positions and the first / last zaber index each one is the
+        nearest anchor of (anchors shadowed by a duplicate are left out)
+        '''
+        order = np.argsort(self.zaber_axis, kind='stable')
+        value, first = np.unique(self.zaber_axis[order], return_index=True)
+        anchor = order[first]
+
+        # boundaries at the midpoints, a tie goes to the first anchor
+        mid = (value[:-1] + value[1:]) / 2
+        tie = (mid == np.floor(mid)) & (anchor[1:] < anchor[:-1])
+        last = np.floor(mid).astype(int) - tie
+        lo = np.concatenate([[0], last + 1])
+        hi = np.concatenate([last, [len(self) - 1]])
+
+        keep = (lo <= hi) & (hi >= 0) & (lo < len(self))
+        return (anchor[keep], np.maximum(lo[keep], 0),
+                np.minimum(hi[keep], len(self) - 1))
+
+    def search(self, anchor, lo, hi, frame):
+        '''
+        First zaber index in [lo, hi] whose (truncated) frame from the
+        given anchor is >= frame, hi + 1 if none. Bisection, elementwise
+        over the arrays; frames increase within a cell
+        '''
+        shape = np.broadcast(lo, hi, frame).shape
+        lo = np.broadcast_to(lo, shape).copy()
+        hi = np.broadcast_to(hi, shape) + 1
+        while np.any(lo < hi):
+            active = lo < hi
+            mid = np.where(active, (lo + hi) // 2, np.minimum(lo, len(self) - 1))
+            above = np.trunc(self.raw_frame(mid, anchor)) >= frame
+            hi = np.where(active & above, mid, hi)
+            lo = np.where(active & ~above, mid + 1, lo)
+        return lo
+
+    def hs_range(self, start, stop):
+        '''
+        HS frame range [first, last + 1) covered by zaber samples
+        [start, stop), None if they all fall outside the video
+        '''
+        start, stop = max(int(start), 0), min(int(stop), len(self))
+        if start >= stop:
+            return None
+
+        # cells clipped to the range, and their samples inside the video
+        anchor, lo, hi = self.cells()
+        keep = (lo < stop) & (hi >= start)
+        anchor = anchor[keep]
+        lo, hi = np.maximum(lo[keep], start), np.minimum(hi[keep], stop - 1)
+
+        first = self.search(anchor, lo, hi, 0)
+        last = self.search(anchor, lo, hi, self.hs_length) - 1
+        keep = first <= last
+        if not np.any(keep):
+            return None
+
+        first = np.trunc(self.raw_frame(first[keep], anchor[keep]))
+        last = np.trunc(self.raw_frame(last[keep], anchor[keep]))
+        return int(first.min()), int(last.max()) + 1
+
+    def time_range(self, t0, t1):
+        '''
+        HS frame range covered by zaber samples with t0 <= time < t1
+        '''
+        return self.hs_range(np.searchsorted(self.t, t0),
+                             np.searchsorted(self.t, t1))
+
+    def zaber_index(self, frame, tol=None):
+        '''
+        Zaber index mapping closest to each HS frame (the first one on
+        ties), -1 for frames outside the video, or further than tol
+        frames from any sample
+        '''
+        frame = np.asarray(frame)
+        flat = frame.ravel()[:, None]
+        anchor, lo, hi = self.cells()
+        if anchor.size == 0:
+            return np.full(frame.shape, -1)
+
+        # within each cell, the first sample at or after the frame, and
+        # the first of the run of samples on the frame just below it
+        after = self.search(anchor, lo, hi, flat)
+        below = np.maximum(after - 1, lo)
+        below = self.search(anchor, lo, hi,
+                            np.trunc(self.raw_frame(below, anchor)))
+        idx = np.concatenate([np.minimum(below, hi), np.minimum(after, hi)],
+                             axis=1)
+        anchor = np.tile(anchor, 2)
+
+        mapped = np.trunc(self.raw_frame(idx, anchor))
+        diff = np.abs(mapped - flat)
+        valid = (mapped >= 0) & (mapped < self.hs_length)
+        diff = np.where(valid, diff, np.inf)
+
+        # closest frame, then smallest zaber index
+        best = np.lexsort((idx, diff), axis=1)[:, 0]
+        row = np.arange(flat.shape[0])
+        result, diff = idx[row, best], diff[row, best]
+
+        flat = flat[:, 0]
+        invalid = (flat < 0) | (flat >= self.hs_length) | np.isinf(diff)
+        if tol is not None:
+            invalid |= diff > tol
+        return np.where(invalid, -1, result).reshape(frame.shape)
+
+    def write_index(self, path, chunk_size=None):
+        '''
+        Write the dense HS frame index as an int32 .npy, chunk_size zaber
+        samples at a time, and return it memory-mapped
+        '''
+        n_sample = len(self)
+        chunk_size = chunk_size or max(n_sample, 1)
+
+        with atomic_path(path) as tmp_path:
+            hs_index = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                                 dtype=np.int32,
+                                                 shape=(n_sample,))
+            try:
+                for start in range(0, n_sample, chunk_size):
+                    idx = np.arange(start, min(start + chunk_size, n_sample))
+                    hs_index[idx] = self.hs_frame(idx)
+                hs_index.flush()
+            finally:
+                # unmapped before the rename (or removal)
+                del hs_index
+
+        return load_index(path)
@@ -67,9 +67,11 @@ def process_file(base_path, csv_filename):
                 print(f"Tracking script not found: {tracking_script}")
                 sys.exit(1)
 
-            # Run calibration
+            # Run calibration, from the hardware frame log if there is one
             print("Running calibration...")
-            run_calibration(base_path, csv_filename, os.path.basename(closest_hs_video))
+            frame_log = find_frame_log(datetime_obj)
+            run_calibration(base_path, csv_filename, os.path.basename(closest_hs_video),
+                            frame_log=frame_log)
 
         else:
             print("Skipping tracking and calibration due to large time difference")
@@ -77,6 +77,27 @@ def find_closest_video(video_files, target_time, timestamp_extractor):
     
     return closest_video, min_time_diff
 
+def find_frame_log(target_time, rig_base='/groups/dennis/dennislab/data/rig',
+                   max_diff=600):
+    """
+    Find the hs_cam_frames CSV (hardware HS frame log) closest to
+    target_time in the rig folder of that day, None if there is none
+    within max_diff seconds
+    """
+    import glob
+    rig_date_folder = os.path.join(rig_base, target_time.strftime('%Y%m%d'))
+    log_files = glob.glob(os.path.join(rig_date_folder, 'hs_cam_frames_*.csv'))
+
+    def extract_frame_log_timestamp(csv_file):
+        basename = os.path.basename(csv_file)
+        return basename.replace('hs_cam_frames_', '').replace('.csv', '')
+
+    closest_log, time_diff = find_closest_video(log_files, target_time,
+                                                extract_frame_log_timestamp)
+    if closest_log is None or time_diff > max_diff:
+        return None
+    return closest_log
+
 def datetime_to_filename_format(dt):
     """
     Convert datetime object to filename format: 2024-02-22T09_46_32
@@ -84,16 +105,25 @@ def datetime_to_filename_format(dt):
     return dt.strftime('%Y-%m-%dT%H_%M_%S')
 
 def run_calibration(base_path, csv_filename, hs_name,
-                    n_point=60, window=45):
-    """Run calibration: initial estimate locally, anchor points on cluster via bsub."""
+                    n_point=60, window=45, frame_log=None):
+    """Run calibration: initial estimate locally, anchor points on cluster via bsub.
+
+    frame_log: hs_cam_frames CSV of the session; the initial lag and search
+    band come from it, and the cluster job verifies it at a few anchors
+    """
     import subprocess
-    from flow.calibrate import calib_video_init
+    from flow.calibrate import calib_video_init, CalibrationSession
+    from flow.calibrate import FrameLog, frame_log_init
+    from flow.compute import has_proxy
     from flow.constants import ZABER_BASE, HS_BASE, TMP_PATH
 
     LOGIN_NODE = "login1.int.janelia.org"
+    CONDA_PYTHON = '/groups/zhang/home/zhangl5/conda/envs/video/bin/python3'
     SCRIPT_PATH = os.path.join(
         os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
         'flow', 'run_calib_cluster.py')
+    PROXY_SCRIPT_PATH = os.path.join(
+        os.path.dirname(SCRIPT_PATH), 'make_proxy.py')
 
     try:
         # Construct paths
@@ -112,12 +142,28 @@ def run_calibration(base_path, csv_filename, hs_name,
             return
 
         # Phase 1: run initial estimate locally
-        result = calib_video_init(zaber_path, video_path, window)
+        log_args = ""
+        result = None
+        if frame_log is not None:
+            print(f'Using frame log {frame_log}')
+            try:
+                with CalibrationSession(zaber_path, video_path) as session:
+                    init_lag, init_window, t_max, max_lag = \
+                        frame_log_init(session, FrameLog(frame_log), window)
+                result = init_lag, init_window, t_max
+                log_args = f' --frame-log "{frame_log}" --max-lag {max_lag}'
+            except Exception as e:
+                # a log that cannot be read must not cost the calibration
+                print(f"⚠️ Warning: Cannot use frame log {frame_log}: {e}")
+                print("Running the initial lag search instead")
+
         if result is None:
-            print("Calibration failed - initial estimate returned None")
-            return
+            result = calib_video_init(zaber_path, video_path, window)
+            if result is None:
+                print("Calibration failed - initial estimate returned None")
+                return
 
-        init_lag, init_window, t_max = result
+            init_lag, init_window, t_max = result
 
         # Phase 2: submit anchor-point calibration to cluster
         job_name = hs_name[:-4] + '_calib'
@@ -126,16 +172,37 @@ def run_calibration(base_path, csv_filename, hs_name,
         os.makedirs(log_dir, exist_ok=True)
         log_path = os.path.abspath(os.path.join(log_dir, f'{job_name}.log'))
 
-        CONDA_PYTHON = '/groups/zhang/home/zhangl5/conda/envs/video/bin/python3'
+        # the proxy makes the anchor seeks cheap: write it first if missing,
+        # the calibration job waits for it (and runs on the video if it fails)
+        depend = ""
+        if not has_proxy(video_path):
+            proxy_job = hs_name[:-4] + '_proxy'
+            proxy_log = os.path.abspath(os.path.join(log_dir, f'{proxy_job}.log'))
+            proxy_cmd = (
+                f"bsub -J {proxy_job} "
+                f"-o {proxy_log} -n 1 "
+                f"'{CONDA_PYTHON} -u {PROXY_SCRIPT_PATH} \"{video_path}\"'"
+            )
+            ssh_result = subprocess.run(
+                ["ssh", "-o", "StrictHostKeyChecking no", "-t",
+                 LOGIN_NODE, proxy_cmd],
+                capture_output=True, text=True,
+            )
+            if ssh_result.returncode != 0:
+                print(f"⚠️ Warning: cannot submit proxy job: {ssh_result.stderr.strip()}")
+            else:
+                print(f"Submitted proxy job: {proxy_job}")
+                depend = f'-w "ended({proxy_job})" '
 
         python_cmd = (
             f"{CONDA_PYTHON} -u {SCRIPT_PATH} "
             f'"{zaber_path}" "{video_path}" "{hs_name}" '
             f"{init_lag} {init_window} {t_max} {n_point} {window}"
+            f"{log_args}"
         )
 
         bsub_cmd = (
-            f"bsub -J {job_name} "
+            f"bsub -J {job_name} {depend}"
             f"-o {log_path} -n 4 "
             f"'{python_cmd}'"
         )